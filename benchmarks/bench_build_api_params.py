@@ -0,0 +1,136 @@
+"""
+Measure the per-request cost of building the Matomo tracking parameters.
+
+The middleware path (``get_host()``, building the parameters and setting the
+visitor cookie) is compared to a frozen copy of the original
+``build_api_params``/``set_cookie`` implementation, and the whole
+``process_response`` is measured with a backend that does not send anything.
+
+Usage (from the repository root)::
+
+    python benchmarks/bench_build_api_params.py
+"""
+import os
+import random
+import sys
+import time
+import timeit
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+from django.test.client import RequestFactory  # noqa: E402
+from django.utils.translation import get_language_from_request  # noqa: E402
+
+from matomo_api_tracking import utils  # noqa: E402
+from matomo_api_tracking.middleware import MatomoApiTrackingMiddleware  # noqa: E402
+
+NUMBER = 20000
+
+
+def baseline_set_cookie(params, response):
+    time_tup = time.localtime(time.time() + params.get('COOKIE_USER_PERSISTENCE'))
+    response.set_cookie(
+        utils.COOKIE_NAME,
+        value=params.get('visitor_id'),
+        expires=time.strftime('%a, %d-%b-%Y %H:%M:%S %Z', time_tup),
+        path=params.get('COOKIE_PATH'),
+    )
+    return response
+
+
+def baseline_build_api_params(request, account, path=None, referer=None, title=None, user_id=None):
+    """``build_api_params`` as it was before the ``ParamBuilder``."""
+    meta = request.META
+    referer = referer or request.GET.get('r', '')
+    custom_uip = None
+    if hasattr(settings, 'CUSTOM_UIP_HEADER') and settings.CUSTOM_UIP_HEADER:
+        custom_uip = meta.get(settings.CUSTOM_UIP_HEADER)
+    path = request.build_absolute_uri(path or request.GET.get('p', '/'))
+    if 'HTTP_X_FORWARDED_FOR' in meta and meta.get('HTTP_X_FORWARDED_FOR', ''):
+        client_ip = meta.get('HTTP_X_FORWARDED_FOR', '').split(',')[0]
+    else:
+        client_ip = meta.get('REMOTE_ADDR', '')
+    user_agent = meta.get('HTTP_USER_AGENT') or meta.get('USER_AGENT', 'Unknown')
+    visitor_id = utils.get_visitor_id(request.COOKIES.get(utils.COOKIE_NAME), client_ip, request)
+    params = {
+        'apiv': utils.VERSION, 'idsite': account, 'rec': 1,
+        'rand': str(random.randint(0, 0x7fffffff)), '_id': visitor_id,
+        'urlref': referer, 'url': path, 'cdt': int(time.time()), 'ua': user_agent,
+    }
+    if user_id:
+        params['uid'] = user_id
+    if 'token_auth' in settings.MATOMO_API_TRACKING:
+        params['cip'] = custom_uip or client_ip
+    if title:
+        params['action_name'] = title
+    locale = get_language_from_request(request)
+    if locale:
+        params['lang'] = locale
+    return {
+        "matomo_params": params,
+        "meta": {
+            'user_agent': user_agent,
+            'language': locale or settings.LANGUAGE_CODE,
+            'visitor_id': visitor_id,
+            'client_ip': client_ip,
+            'COOKIE_USER_PERSISTENCE': utils.COOKIE_USER_PERSISTENCE,
+            'COOKIE_NAME': utils.COOKIE_NAME,
+            'COOKIE_PATH': utils.COOKIE_PATH,
+        },
+    }
+
+
+class NoopBackend:
+
+    def send(self, params, meta):
+        pass
+
+
+def make_request():
+    return RequestFactory().get(
+        "/some/path/",
+        HTTP_HOST="localhost",
+        HTTP_USER_AGENT="Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0",
+        HTTP_ACCEPT_LANGUAGE="de-CH,de;q=0.9,en-US;q=0.8,en;q=0.7",
+        HTTP_X_FORWARDED_FOR="203.0.113.7, 10.0.0.1",
+        HTTP_REFERER="https://www.example.com/",
+    )
+
+
+def report(name, stmt):
+    best = min(timeit.repeat(stmt, number=NUMBER, repeat=5))
+    print("{:<32} {:8.2f} us/call".format(name, best / NUMBER * 1e6))
+
+
+def baseline_path(request, response):
+    data = baseline_build_api_params(
+        request, 1, path=request.path, referer=request.META.get('HTTP_REFERER'), title="Some page title")
+    baseline_set_cookie(data['meta'], response)
+
+
+def middleware_path(builder, request, response):
+    host = request.get_host()
+    params, meta = builder.build(
+        request, 1, path=request.path, referer=request.META.get('HTTP_REFERER'), title="Some page title",
+        host=host)
+    utils.set_cookie(meta, response)
+
+
+if __name__ == "__main__":
+    request = make_request()
+    response = HttpResponse(b"{}", content_type="application/json")
+    builder = utils.get_param_builder()
+    report("baseline build + set_cookie", lambda: baseline_path(request, response))
+    report("get_host + build + set_cookie", lambda: middleware_path(builder, request, response))
+
+    middleware = MatomoApiTrackingMiddleware(lambda request: response)
+    with patch("matomo_api_tracking.middleware.get_backend", return_value=NoopBackend()):
+        report("process_response (no-op backend)", lambda: middleware.process_response(request, response))
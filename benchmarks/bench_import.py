@@ -0,0 +1,54 @@
+"""
+Measure the import time of the middleware and of the tracking backends.
+
+Every scenario runs in a fresh interpreter with ``-X importtime``. The
+report shows the time spent importing after ``django.setup()`` and which of
+the optional heavy dependencies were loaded.
+
+Usage (from the repository root)::
+
+    python benchmarks/bench_import.py
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("bs4", "celery", "redis", "requests")
+BACKENDS = {
+    "direct": "matomo_api_tracking.backends.direct.DirectTrackingBackend",
+    "celery": "matomo_api_tracking.backends.celery.CeleryTrackingBackend",
+    "redis_batch": "matomo_api_tracking.backends.redis_batch.RedisBatchTrackingBackend",
+}
+SCRIPT = """
+import sys, django
+django.setup()
+sys.stderr.write("--- setup done\\n")
+from django.conf import settings
+settings.MATOMO_API_TRACKING = dict(settings.MATOMO_API_TRACKING, backend={backend!r},
+                                    redis_url="redis://localhost:6379/0")
+import matomo_api_tracking.middleware
+from matomo_api_tracking.dispatcher import get_backend
+get_backend()
+print(",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def measure(backend):
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE="test_settings", PYTHONPATH=ROOT)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SCRIPT.format(backend=backend, heavy=HEAVY_MODULES)],
+        capture_output=True, text=True, env=env, cwd=ROOT, check=True)
+    after_setup = proc.stderr.split("--- setup done\n", 1)[1]
+    total_us = 0
+    for line in after_setup.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        if line.startswith("import time:") and not line.startswith("import time: self"):
+            total_us += int(line.split("|")[0].split(":")[1])
+    return total_us, proc.stdout.strip()
+
+
+if __name__ == "__main__":
+    for name, backend in BACKENDS.items():
+        best = min(measure(backend) for _ in range(5))
+        print("{:<12} {:8.1f} ms   loaded: {}".format(name, best[0] / 1000, best[1] or "-"))
@@ -0,0 +1,97 @@
+"""
+Client-side pre-aggregation of tracking events.
+
+Hits on the path prefixes listed in ``aggregate_paths`` are not queued one by
+one. Instead, they are counted per (url, visitor, time window) in Redis and
+turned into a single summarized event once the window is closed. The number
+of hits is reported in the custom dimension ``aggregate_dimension`` or, if no
+dimension is configured, in the page scope custom variable ``hits``.
+"""
+import json
+import time
+from urllib.parse import urlsplit
+
+DEFAULT_WINDOW = 60
+
+
+def get_window(config) -> int:
+    try:
+        return max(int(config.get("aggregate_window", DEFAULT_WINDOW)), 1)
+    except ValueError:
+        raise Exception("Matomo aggregate_window must be a numeric value")
+
+
+def should_aggregate(params: dict, config) -> bool:
+    prefixes = config.get("aggregate_paths")
+    if not prefixes:
+        return False
+    path = urlsplit(params.get("url", "")).path
+    return path.startswith(tuple(prefixes))
+
+
+def _index_key(key):
+    return "{}:agg".format(key)
+
+
+def _window_keys(key, window_id):
+    return "{}:agg:{}:n".format(key, window_id), "{}:agg:{}:e".format(key, window_id)
+
+
+def aggregate(pipe, key: str, event: dict, config):
+    """Queue the commands counting ``event`` in its aggregation window of the
+    list ``key`` on the Redis pipeline ``pipe``.
+
+    ``pipe`` must be a transactional (MULTI) pipeline, as
+    ``release_closed_windows`` may otherwise read the count of a hit
+    without its event.
+    """
+    params = event["params"]
+    window = get_window(config)
+    window_id = int(params.get("cdt") or time.time()) // window
+    counts_key, events_key = _window_keys(key, window_id)
+    field = json.dumps([params.get("url"), params.get("_id")])
+
+    pipe.hsetnx(events_key, field, json.dumps(event))
+    pipe.hincrby(counts_key, field, 1)
+    pipe.zadd(_index_key(key), {window_id: window_id})
+
+
+def summarize(event: dict, count: int, config) -> dict:
+    """Return a copy of ``event`` carrying the number of aggregated hits."""
+    params = dict(event["params"])
+    dimension = config.get("aggregate_dimension")
+    if dimension:
+        params["dimension{}".format(dimension)] = count
+    else:
+        params["cvar"] = json.dumps({"1": ["hits", str(count)]})
+    return {"params": params, "meta": event.get("meta", {})}
+
+
+def release_closed_windows(redis_client, key: str, config) -> int:
+    """
+    Move the summaries of all closed aggregation windows of ``key`` onto the
+    list ``key``, where they are picked up by the regular batch flush.
+    Returns the number of summarized events queued.
+    """
+    window = get_window(config)
+    current = int(time.time()) // window
+    index_key = _index_key(key)
+    queued = 0
+    for window_id in redis_client.zrangebyscore(index_key, "-inf", current - 1):
+        window_id = int(window_id)
+        counts_key, events_key = _window_keys(key, window_id)
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hgetall(counts_key)
+        pipe.hgetall(events_key)
+        pipe.delete(counts_key, events_key)
+        pipe.zrem(index_key, window_id)
+        counts, events, _, _ = pipe.execute()
+
+        summaries = [
+            json.dumps(summarize(json.loads(events[field]), int(count), config))
+            for field, count in counts.items() if field in events
+        ]
+        if summaries:
+            redis_client.rpush(key, *summaries)
+            queued += len(summaries)
+    return queued
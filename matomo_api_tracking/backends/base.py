@@ -1,5 +1,7 @@
 from django.conf import settings
 
+from ..routing import get_route_table
+
 
 class BaseTrackingBackend:
     """Base class for Matomo tracking backends."""
@@ -14,5 +16,9 @@ class BaseTrackingBackend:
         except ValueError:
             raise Exception("Matomo timeout must be a numeric value")
 
+    def get_route(self, meta: dict):
+        """Return the site route an event is destined for."""
+        return get_route_table().get(meta.get("site"))
+
     def send(self, params: dict, meta: dict):
-        raise NotImplementedError("Tracking backends must implement send()")
\ No newline at end of file
+        raise NotImplementedError("Tracking backends must implement send()")
@@ -1,14 +1,29 @@
 import logging
+from django.conf import settings
 from ..tasks import send_matomo_tracking
 from .base import BaseTrackingBackend
 logger = logging.getLogger(__name__)
 
 
 class CeleryTrackingBackend(BaseTrackingBackend):
-    """Default backend: send via Celery."""
+    """Default backend: send via Celery.
+
+    Events of a priority lane listed in ``priority_queues`` are sent to the
+    Celery queue configured for it, all others to the default queue.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.queues = settings.MATOMO_API_TRACKING.get("priority_queues", {})
 
     def send(self, params, meta):
         try:
-            send_matomo_tracking.delay(params, meta, matomo_url=self.url, timeout=self.timeout)
+            route = self.get_route(meta)
+            kwargs = {"matomo_url": route.url, "timeout": self.timeout, "token_auth": route.token_auth}
+            queue = self.queues.get(meta.get("priority", "default"))
+            if queue:
+                send_matomo_tracking.apply_async((params, meta), kwargs, queue=queue)
+            else:
+                send_matomo_tracking.delay(params, meta, **kwargs)
         except Exception as e:
             logger.error("cannot send tracking post: %s", e)
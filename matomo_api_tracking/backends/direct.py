@@ -1,8 +1,9 @@
-from ..tasks import send_matomo_tracking
 from .base import BaseTrackingBackend
 
 
 class DirectTrackingBackend(BaseTrackingBackend):
     """Send immediately (no Celery), useful for testing."""
-    def send(self, params, meta, timeout):
-        send_matomo_tracking(params, timeout=timeout)
\ No newline at end of file
+    def send(self, params, meta):
+        from ..transport import send_single_tracking_event
+        route = self.get_route(meta)
+        send_single_tracking_event(params, meta, route.url, self.timeout, route.token_auth)
@@ -1,24 +1,174 @@
+import atexit
 import json
-try:
-    import redis
-except ImportError:
-    redis = None
+import logging
+import os
+import queue
+import threading
+import time
 from django.conf import settings
+from ..aggregation import aggregate, should_aggregate
+from ..connections import get_redis, require_redis
+from ..routing import queue_key
+from ..utils import DropCounter
 from .base import BaseTrackingBackend
 
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Collects events in memory and writes them with one pipeline per batch.
+
+    A background thread of the current process writes a batch as soon as it
+    holds ``max_events`` events or ``interval`` seconds after its first
+    event arrived. ``put()`` never waits: if ``queue_size`` events are
+    pending, new events are dropped.
+    """
+
+    def __init__(self, write, interval=0.005, max_events=100, queue_size=10000):
+        self.write = write
+        self.interval = interval
+        self.max_events = max_events
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self.dropped = DropCounter(logger, "Matomo Redis batch queue full")
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid != pid:
+                # events queued by a parent process are its own to write
+                self._queue = queue.Queue(self.queue_size)
+                threading.Thread(
+                    target=self._run, name="matomo-redis-batch", daemon=True).start()
+                self._pid = pid
+
+    def put(self, item):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped.add()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.max_events:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            self.write(batch)
+        except Exception:
+            logger.exception("cannot write %d tracking events to Redis", len(batch))
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _run(self):
+        while True:
+            self._write(self._collect(self._queue.get()))
+
+    def flush(self, timeout=5.0):
+        """Write all pending events and wait until they are written.
+
+        Events that are not written within ``timeout`` seconds, e.g. while
+        Redis is unavailable, are dropped, so a shutdown never hangs.
+        """
+        if self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + timeout
+        # the background thread writes the pending events
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._queue.all_tasks_done.wait(remaining)
+        dropped = 0
+        try:
+            while True:
+                self._queue.get_nowait()
+                self._queue.task_done()
+                dropped += 1
+        except queue.Empty:
+            pass
+        if dropped:
+            logger.warning("Matomo Redis batch flush timed out, dropped %d tracking events.", dropped)
+
 
 class RedisBatchTrackingBackend(BaseTrackingBackend):
-    """Push tracking events to Redis list for batch flush."""
+    """Push tracking events to Redis list for batch flush.
+
+    Events of every configured site and priority lane are kept in their own
+    list (``<redis_key>[:<host>][:<lane>]``) so they can be flushed
+    independently.
+    If ``redis_batch_interval`` is set, events are written by a background
+    thread that combines the events of up to ``redis_batch_max_events``
+    requests into one pipelined RPUSH per list.
+    """
     def __init__(self):
         super().__init__()
-        if not redis:
-            raise Exception("Redis not installed")
+        require_redis()
         config = settings.MATOMO_API_TRACKING
-        self.redis = redis.Redis.from_url(config["redis_url"])
+        self.config = config
+        self.redis_url = config["redis_url"]
         self.key = config.get("redis_key", "matomo_events")
+        self.batcher = None
+        if config.get("redis_batch_interval"):
+            self.batcher = MicroBatcher(
+                self.write,
+                interval=float(config["redis_batch_interval"]),
+                max_events=int(config.get("redis_batch_max_events", 100)),
+                queue_size=int(config.get("redis_batch_queue_size", 10000)),
+            )
+            atexit.register(self.batcher.flush)
+
+    @property
+    def redis(self):
+        # connect lazily, from the connection pool of the current process;
+        # the request never waits for a free connection
+        return get_redis(self.redis_url, blocking=False)
+
+    def write(self, items):
+        """Write ``(key, event)`` pairs with a single pipeline.
+
+        If events are aggregated, the pipeline runs as a MULTI transaction,
+        so a flush never sees the count of a hit without its event.
+        """
+        pending = {}
+        aggregated = []
+        for key, event in items:
+            if should_aggregate(event["params"], self.config):
+                aggregated.append((key, event))
+            else:
+                pending.setdefault(key, []).append(json.dumps(event))
+        pipe = self.redis.pipeline(transaction=bool(aggregated))
+        for key, event in aggregated:
+            aggregate(pipe, key, event, self.config)
+        for key, values in pending.items():
+            pipe.rpush(key, *values)
+        pipe.execute()
 
     def send(self, params, meta):
-        self.redis.rpush(
-            self.key,
-            json.dumps({"params": params, "meta": meta}),
-        )
\ No newline at end of file
+        key = queue_key(self.key, meta.get("site"), meta.get("priority"))
+        event = {"params": params, "meta": meta}
+        try:
+            if self.batcher is not None:
+                self.batcher.put((key, event))
+            elif should_aggregate(params, self.config):
+                self.write([(key, event)])
+            else:
+                self.redis.rpush(key, json.dumps(event))
+        except Exception as e:
+            logger.error("cannot push tracking event to Redis: %s", e)
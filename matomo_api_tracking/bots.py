@@ -0,0 +1,58 @@
+import random
+import re
+from functools import lru_cache
+
+from .utils import cached_for_config
+
+# case-insensitive substrings identifying crawlers, monitoring and HTTP libraries
+BOT_SIGNATURES = (
+    "crawl", "spider", "slurp", "archiver", "facebookexternalhit",
+    "mediapartners-google", "lighthouse", "headlesschrome", "phantomjs",
+    "python-requests", "python-urllib", "aiohttp", "httpx", "go-http-client",
+    "okhttp", "java/", "libwww-perl", "curl/", "wget/", "httpie", "scrapy",
+    "kube-probe", "elb-healthchecker", "googlehc", "pingdom", "statuscake",
+    "site24x7", "slackbot", "duckduckbot",
+)
+# regular expressions for short words that also occur inside device and app
+# names of real browsers (e.g. "CUBOT_X30"), so they only match as a token
+BOT_PATTERNS = (
+    r"\bbot\b", r"bot/", r"health[-_ ]?check", r"\buptime\b",
+    r"\bmonitor(?:ing)?\b",
+)
+
+
+class BotFilter:
+    """Classifies user agents against a single precompiled signature regex.
+
+    ``signatures`` are plain substrings, ``patterns`` regular expressions.
+    Verdicts are cached per user agent string. With a ``sample_rate`` > 0,
+    that fraction of the bot hits is still tracked.
+    """
+
+    def __init__(self, signatures=BOT_SIGNATURES, sample_rate=0.0, cache_size=4096,
+                 patterns=BOT_PATTERNS):
+        self.pattern = re.compile(
+            "|".join(list(patterns) + [re.escape(s) for s in signatures]), re.IGNORECASE)
+        self.sample_rate = sample_rate
+        self.is_bot = lru_cache(maxsize=cache_size)(self._is_bot)
+
+    def _is_bot(self, user_agent):
+        return self.pattern.search(user_agent) is not None
+
+    def should_drop(self, request):
+        user_agent = request.META.get("HTTP_USER_AGENT")
+        if not user_agent or not self.is_bot(user_agent):
+            return False
+        return self.sample_rate <= 0 or random.random() >= self.sample_rate
+
+
+@cached_for_config
+def get_bot_filter(config):
+    """Return the bot filter for the given config, or None if disabled."""
+    if not config.get("filter_bots", False):
+        return None
+    try:
+        sample_rate = float(config.get("bot_sample_rate", 0))
+    except ValueError:
+        raise Exception("Matomo bot_sample_rate must be a numeric value")
+    return BotFilter(BOT_SIGNATURES + tuple(config.get("bot_user_agents", ())), sample_rate)
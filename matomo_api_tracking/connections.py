@@ -0,0 +1,65 @@
+import os
+import threading
+
+from django.conf import settings
+
+_NOT_LOADED = object()
+# imported on first use, None if redis is not installed
+redis = _NOT_LOADED
+_clients = {}
+_pid = None
+_lock = threading.Lock()
+
+
+def require_redis():
+    global redis
+    if redis is _NOT_LOADED:
+        try:
+            import redis as redis_module
+        except ImportError:
+            redis_module = None
+        redis = redis_module
+    if redis is None:
+        raise Exception("Redis not installed")
+
+
+def get_redis(url=None, blocking=True):
+    """
+    Return the Redis client of this process for ``url`` (default: ``redis_url``).
+
+    Clients are created on first use and share one bounded connection pool
+    per url and process. After a fork, the child process gets new pools
+    instead of reusing the connections of its parent.
+    With ``blocking=False``, as used on the request path, the pool raises a
+    ``ConnectionError`` instead of waiting when all its connections are in use,
+    and connecting or waiting for a reply times out after
+    ``redis_socket_timeout`` seconds.
+    """
+    global _pid
+    require_redis()
+    config = settings.MATOMO_API_TRACKING
+    url = url or config["redis_url"]
+    pid = os.getpid()
+    with _lock:
+        if _pid != pid:
+            _clients.clear()
+            _pid = pid
+        client = _clients.get((url, blocking))
+        if client is None:
+            max_connections = int(config.get("redis_max_connections", 64))
+            if blocking:
+                pool = redis.BlockingConnectionPool.from_url(
+                    url,
+                    max_connections=max_connections,
+                    timeout=float(config.get("redis_pool_timeout", 5)),
+                )
+            else:
+                socket_timeout = float(config.get("redis_socket_timeout", 0.5))
+                pool = redis.ConnectionPool.from_url(
+                    url,
+                    max_connections=max_connections,
+                    socket_timeout=socket_timeout,
+                    socket_connect_timeout=socket_timeout,
+                )
+            client = _clients[url, blocking] = redis.Redis(connection_pool=pool)
+        return client
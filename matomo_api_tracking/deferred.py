@@ -0,0 +1,93 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+from django.conf import settings
+
+from .utils import COOKIE_NAME, DropCounter, get_client_ip, get_visitor_id
+
+logger = logging.getLogger(__name__)
+dropped = DropCounter(logger, "Matomo deferred tracking queue full")
+
+
+class RequestSnapshot:
+    """The parts of a request needed to build its tracking parameters.
+
+    It is taken while the request is handled, so the tracking can be done
+    after the response was returned, without keeping the request alive.
+    The visitor id is resolved right away, as it is needed for the cookie.
+    """
+
+    def __init__(self, request, host):
+        self.path = request.path
+        self.scheme = request.scheme
+        self.host = host
+        self.META = {
+            key: value for key, value in request.META.items()
+            if key.startswith('HTTP_') or key in ('REMOTE_ADDR', 'USER_AGENT')
+        }
+        self.GET = {'r': request.GET['r']} if 'r' in request.GET else {}
+        self.COOKIES = dict(request.COOKIES)
+        self.visitor_id = get_visitor_id(
+            request.COOKIES.get(COOKIE_NAME), get_client_ip(request.META), request)
+        self.COOKIES[COOKIE_NAME] = self.visitor_id
+
+    def get_host(self):
+        return self.host
+
+    def build_absolute_uri(self, location):
+        return urljoin('{}://{}{}'.format(self.scheme, self.host, self.path), location)
+
+
+_executor = None
+_executor_pid = None
+_slots = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor, _executor_pid, _slots
+    pid = os.getpid()
+    with _lock:
+        # the threads of the pool do not survive a fork
+        if _executor is None or _executor_pid != pid:
+            _executor_pid = pid
+            config = settings.MATOMO_API_TRACKING
+            _executor = ThreadPoolExecutor(
+                max_workers=int(config.get('deferred_workers', 2)),
+                thread_name_prefix='matomo-tracking')
+            _slots = threading.BoundedSemaphore(int(config.get('deferred_queue_size', 10000)))
+        return _executor
+
+
+def submit(fn, *args):
+    """Run ``fn(*args)`` on the tracking thread pool.
+
+    If more than ``deferred_queue_size`` calls are pending, the call is
+    dropped rather than blocking the request.
+    """
+    executor = get_executor()
+    if not _slots.acquire(blocking=False):
+        dropped.add()
+        return None
+    return executor.submit(_run, _slots, fn, args)
+
+
+def _run(slots, fn, args):
+    try:
+        fn(*args)
+    except Exception:
+        logger.exception("deferred Matomo tracking failed")
+    finally:
+        slots.release()
+
+
+def shutdown(wait=True):
+    """Stop the thread pool, waiting for the pending tracking calls."""
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
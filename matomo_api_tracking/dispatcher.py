@@ -1,13 +1,23 @@
+import os
+
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.utils.module_loading import import_string
 
 _backend_instance = None
+_backend_pid = None
 
 
 def get_backend():
-    """Return singleton backend instance based on settings."""
-    global _backend_instance
-    if _backend_instance:
+    """Return the backend instance of this process based on settings.
+
+    The instance is created on first use and again after a fork, so that
+    forked workers never share the backend state of their parent.
+    """
+    global _backend_instance, _backend_pid
+    pid = os.getpid()
+    if _backend_instance and _backend_pid == pid:
         return _backend_instance
 
     config = settings.MATOMO_API_TRACKING
@@ -18,4 +28,12 @@ def get_backend():
 
     backend_class = import_string(backend_path)
     _backend_instance = backend_class()
-    return _backend_instance
\ No newline at end of file
+    _backend_pid = pid
+    return _backend_instance
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    global _backend_instance
+    if setting == "MATOMO_API_TRACKING":
+        _backend_instance = None
@@ -0,0 +1,228 @@
+"""
+Load testing of the whole tracking pipeline against a local stub Matomo server.
+
+``StubMatomoServer`` records the single (GET) and bulk (POST) tracking
+requests it receives and can inject latency, errors and timeouts.
+``run_load_test`` pushes synthetic requests through the
+``MatomoApiTrackingMiddleware`` with a given backend, flushes the Redis batch
+queue if needed, and reports throughput, queue lag, loss and duplicates.
+"""
+import json
+import random
+import re
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+
+from .middleware import MatomoApiTrackingMiddleware
+
+BACKENDS = {
+    "direct": "matomo_api_tracking.backends.direct.DirectTrackingBackend",
+    "celery": "matomo_api_tracking.backends.celery.CeleryTrackingBackend",
+    "redis_batch": "matomo_api_tracking.backends.redis_batch.RedisBatchTrackingBackend",
+}
+HIT_PATH = re.compile(r"/loadtest/(\d+)/")
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self._handle("single", [dict(parse_qsl(urlsplit(self.path).query))])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            payload = json.loads(body)
+            hits = [dict(parse_qsl(urlsplit(r).query)) for r in payload["requests"]]
+        except (ValueError, KeyError, TypeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        self._handle("bulk", hits)
+
+    def _handle(self, kind, hits):
+        status = self.server.stub.respond(kind, hits)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubMatomoServer:
+    """Local HTTP server standing in for ``matomo.php``.
+
+    Every request waits ``latency`` seconds. With probability ``error_rate``
+    it fails with a 500 and nothing is recorded. With probability
+    ``timeout_rate`` the hits are recorded, but the response is delayed by
+    ``timeout_delay`` seconds, as for a Matomo server that is too slow for
+    the client timeout.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, timeout_rate=0.0, timeout_delay=10.0,
+                 host="127.0.0.1", port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_delay = timeout_delay
+        self.hits = []
+        self.requests = {"single": 0, "bulk": 0, "failed": 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _StubHandler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}/matomo.php".format(host, port)
+
+    def respond(self, kind, hits):
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.requests["failed"] += 1
+            return 500
+        received = time.time()
+        with self._lock:
+            self.requests[kind] += 1
+            self.hits.extend((received, hit) for hit in hits)
+        if random.random() < self.timeout_rate:
+            time.sleep(self.timeout_delay)
+        return 200
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _flush_loop(stop, interval, batch_size):
+    from .tasks import flush_matomo_batch
+    while True:
+        flush_matomo_batch(batch_size=batch_size)
+        if stop.wait(interval):
+            flush_matomo_batch(batch_size=batch_size)
+            return
+
+
+def _delete_redis_keys(key):
+    from .connections import get_redis
+    r = get_redis()
+    for name in r.scan_iter(match="{}*".format(key)):
+        r.delete(name)
+
+
+def run_load_test(backend, stub, requests=1000, concurrency=8, config=None,
+                  flush_interval=1.0, batch_size=500, drain_timeout=30.0, host="testserver"):
+    """
+    Send ``requests`` synthetic page views through the middleware using
+    ``backend`` and wait up to ``drain_timeout`` seconds for them to arrive
+    at the ``stub`` server. ``config`` is merged into ``MATOMO_API_TRACKING``.
+    Returns a dict of metrics.
+
+    All hits go to the default site, and the events of the Redis batch
+    backend are queued under a ``redis_key`` of their own, which is deleted
+    afterwards, so the queues of a live site are never flushed to the stub.
+    """
+    tracking = dict(settings.MATOMO_API_TRACKING, **(config or {}))
+    tracking.pop("sites", None)
+    tracking.pop("priority_paths", None)
+    tracking.update(
+        backend=BACKENDS.get(backend, backend), url=stub.url,
+        redis_key="matomo_loadtest:{}".format(uuid.uuid4().hex))
+    allowed_hosts = list(settings.ALLOWED_HOSTS) + [host]
+    html = b"<html><head><title>load test</title></head><body></body></html>"
+    middleware = MatomoApiTrackingMiddleware(lambda request: HttpResponse(html))
+    factory = RequestFactory()
+    sent_at = {}
+    first_hit = len(stub.hits)
+    stub_requests = dict(stub.requests)
+
+    def hit(n):
+        request = factory.get(
+            "/loadtest/{}/".format(n), HTTP_HOST=host,
+            HTTP_USER_AGENT="Mozilla/5.0 (X11; Linux x86_64) load test",
+            REMOTE_ADDR="10.{}.{}.{}".format(n >> 16 & 255, n >> 8 & 255, n & 255))
+        sent_at[n] = time.time()
+        middleware(request)
+
+    with override_settings(MATOMO_API_TRACKING=tracking, ALLOWED_HOSTS=allowed_hosts):
+        stop = threading.Event()
+        flusher = None
+        if tracking["backend"] == BACKENDS["redis_batch"]:
+            flusher = threading.Thread(target=_flush_loop, args=(stop, flush_interval, batch_size))
+            flusher.start()
+
+        try:
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(hit, range(requests)))
+            sent_duration = time.time() - start
+
+            deadline = time.time() + drain_timeout
+            while time.time() < deadline:
+                if len({_hit_number(h) for _, h in stub.hits[first_hit:]}) >= requests:
+                    break
+                time.sleep(0.1)
+        finally:
+            stop.set()
+            if flusher is not None:
+                flusher.join()
+                _delete_redis_keys(tracking["redis_key"])
+        total_duration = time.time() - start
+
+    lags = []
+    seen = {}
+    for received, params in stub.hits[first_hit:]:
+        n = _hit_number(params)
+        if n is None or n not in sent_at:
+            continue
+        seen[n] = seen.get(n, 0) + 1
+        if seen[n] == 1:
+            lags.append(received - sent_at[n])
+
+    delivered = len(seen)
+    return {
+        "backend": backend,
+        "requests": requests,
+        "request_throughput": requests / sent_duration if sent_duration else 0.0,
+        "delivery_throughput": delivered / total_duration if total_duration else 0.0,
+        "lag_p50": statistics.median(lags) if lags else None,
+        "lag_p95": _percentile(lags, 0.95) if lags else None,
+        "lag_max": max(lags) if lags else None,
+        "loss_rate": 1 - delivered / requests if requests else 0.0,
+        "duplicate_rate": sum(count - 1 for count in seen.values()) / requests if requests else 0.0,
+        "stub_requests": {kind: count - stub_requests[kind] for kind, count in stub.requests.items()},
+    }
+
+
+def _hit_number(params):
+    match = HIT_PATH.search(params.get("url", ""))
+    return int(match.group(1)) if match else None
@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand
+
+from ...loadtest import BACKENDS, StubMatomoServer, run_load_test
+
+
+def _format_seconds(value):
+    return "-" if value is None else "{:.3f}s".format(value)
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the tracking pipeline (middleware, backend, queue, flush) "
+        "against a local stub Matomo server."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--backend", action="append", dest="backends",
+            help="backend to test: {} or a dotted path; can be repeated (default: direct)".format(
+                ", ".join(BACKENDS)))
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument("--concurrency", type=int, default=8, help="concurrent request threads")
+        parser.add_argument("--latency", type=float, default=0.0, help="stub response latency in seconds")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of failing stub responses")
+        parser.add_argument(
+            "--timeout-rate", type=float, default=0.0,
+            help="fraction of stub responses delayed beyond the client timeout")
+        parser.add_argument("--timeout", type=float, default=2.0, help="client timeout in seconds")
+        parser.add_argument("--flush-interval", type=float, default=1.0)
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--drain-timeout", type=float, default=30.0)
+        parser.add_argument("--deferred", action="store_true", help="enable deferred tracking")
+
+    def handle(self, *args, **options):
+        config = {"timeout": options["timeout"]}
+        if options["deferred"]:
+            config["deferred"] = True
+        stub = StubMatomoServer(
+            latency=options["latency"],
+            error_rate=options["error_rate"],
+            timeout_rate=options["timeout_rate"],
+            timeout_delay=options["timeout"] + 1,
+        )
+        with stub:
+            self.stdout.write("stub Matomo server listening on {}".format(stub.url))
+            for backend in options["backends"] or ["direct"]:
+                result = run_load_test(
+                    backend,
+                    stub,
+                    requests=options["requests"],
+                    concurrency=options["concurrency"],
+                    config=config,
+                    flush_interval=options["flush_interval"],
+                    batch_size=options["batch_size"],
+                    drain_timeout=options["drain_timeout"],
+                )
+                self.stdout.write(
+                    "{backend}: {request_throughput:.1f} req/s through the middleware, "
+                    "{delivery_throughput:.1f} events/s delivered".format(**result))
+                self.stdout.write(
+                    "  queue lag p50 {} p95 {} max {}".format(
+                        _format_seconds(result["lag_p50"]),
+                        _format_seconds(result["lag_p95"]),
+                        _format_seconds(result["lag_max"])))
+                self.stdout.write(
+                    "  loss {:.2%}, duplicates {:.2%}, stub requests {}".format(
+                        result["loss_rate"], result["duplicate_rate"], result["stub_requests"]))
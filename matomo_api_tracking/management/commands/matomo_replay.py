@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...replay import ASSET_EXTENSIONS, COMBINED_LOG_FORMAT, STATUSES, TIME_FORMAT, Checkpoint, replay
+from ...routing import get_route_table
+
+
+def _split(value):
+    return tuple(v.strip() for v in value.split(",") if v.strip())
+
+
+class Command(BaseCommand):
+    help = "Replay (optionally gzipped) access logs into the Matomo bulk tracking API."
+
+    def add_arguments(self, parser):
+        parser.add_argument("log_files", nargs="+", help="access log files, plain or .gz")
+        parser.add_argument(
+            "--host", required=True,
+            help="host of the tracked urls, also used to select the Matomo site")
+        parser.add_argument("--scheme", default="https")
+        parser.add_argument(
+            "--checkpoint",
+            help="JSON file storing the progress; an interrupted replay resumes from it")
+        parser.add_argument("--chunk-size", type=int, default=500, help="events per bulk request")
+        parser.add_argument("--concurrency", type=int, default=4, help="bulk requests in flight")
+        parser.add_argument("--retries", type=int, default=3)
+        parser.add_argument("--methods", default="GET", help="comma separated HTTP methods to track")
+        parser.add_argument(
+            "--status", default=",".join(s + "xx" for s in STATUSES),
+            help="comma separated status codes or classes to track, e.g. 2xx,304 (default: 2xx,3xx)")
+        parser.add_argument(
+            "--exclude-paths", default="",
+            help="comma separated path prefixes to skip, in addition to ignore_paths")
+        parser.add_argument(
+            "--exclude-extensions", default=",".join(ASSET_EXTENSIONS),
+            help="comma separated file extensions to skip (default: common static assets)")
+        parser.add_argument(
+            "--log-format", default=COMBINED_LOG_FORMAT,
+            help="regex with the named groups ip, time, method, path and optionally "
+                 "status, referer, ua and host (default: nginx combined format)")
+        parser.add_argument("--time-format", default=TIME_FORMAT)
+
+    def handle(self, *args, **options):
+        if get_route_table().resolve(options["host"]).token_auth is None:
+            self.stderr.write(
+                "No token_auth configured: Matomo ignores the timestamp of hits "
+                "older than 24 hours without it.")
+        checkpoint = Checkpoint(options["checkpoint"])
+        methods = tuple(m.upper() for m in _split(options["methods"]))
+        statuses = tuple(s.lower().rstrip("x") for s in _split(options["status"]))
+        for log_file in options["log_files"]:
+            try:
+                sent = replay(
+                    log_file, options["host"], checkpoint,
+                    scheme=options["scheme"],
+                    chunk_size=options["chunk_size"],
+                    concurrency=options["concurrency"],
+                    retries=options["retries"],
+                    pattern=options["log_format"],
+                    time_format=options["time_format"],
+                    methods=methods,
+                    statuses=statuses,
+                    exclude_paths=_split(options["exclude_paths"]),
+                    exclude_extensions=_split(options["exclude_extensions"]),
+                )
+            except Exception as e:
+                raise CommandError("{}: {}".format(log_file, e))
+            self.stdout.write("{}: {} events sent".format(log_file, sent))
@@ -1,12 +1,53 @@
 from django.conf import settings
-from bs4 import BeautifulSoup
 import logging
+import re
 
-from .utils import build_api_params, set_cookie
+from .bots import get_bot_filter
+from .deferred import RequestSnapshot, submit
+from .utils import get_param_builder, set_cookie
 from .dispatcher import get_backend
+from .routing import get_priority_table, resolve_site
 
 logger = logging.getLogger(__name__)
 
+HEAD_START = re.compile(rb"<head[\s>]", re.IGNORECASE)
+
+
+def get_html_content(response):
+    """Return the content of an HTML response, None for other responses."""
+    try:
+        if (response.content[:100].lower().find(b"<html>") >= 0 or
+                response.accepted_media_type == "text/html"):
+            return response.content
+    except AttributeError:
+        pass
+    return None
+
+
+def get_title(content):
+    """Return the title in the ``<head>`` of an HTML page.
+
+    Only the ``<title>`` element is parsed, so the cost does not depend on
+    the size of the page.
+    """
+    if content is None:
+        return None
+    head = HEAD_START.search(content)
+    if head is None:
+        return None
+    lowered = content.lower()
+    head_end = lowered.find(b"</head>", head.end())
+    start = lowered.find(b"<title", head.end(), None if head_end < 0 else head_end)
+    end = lowered.find(b"</title>", start)
+    if start < 0 or end < 0:
+        return None
+    from bs4 import BeautifulSoup  # only loaded once an HTML page is tracked
+    element = b"<html><head>" + content[start:end + len(b"</title>")] + b"</head></html>"
+    try:
+        return BeautifulSoup(element, "html.parser").html.head.title.text
+    except AttributeError:
+        return None
+
 
 class MatomoApiTrackingMiddleware:
     def __init__(self, get_response=None):
@@ -19,9 +60,10 @@ class MatomoApiTrackingMiddleware:
 
     def process_response(self, request, response):
         try:
-            _ = settings.MATOMO_API_TRACKING['url']
-            account = settings.MATOMO_API_TRACKING['site_id']
-            ignore_paths = settings.MATOMO_API_TRACKING.get('ignore_paths', [])
+            config = settings.MATOMO_API_TRACKING
+            _ = config['url']
+            _ = config['site_id']
+            ignore_paths = config.get('ignore_paths', [])
         except (AttributeError, KeyError):
             raise Exception("Matomo configuration incomplete")
 
@@ -29,26 +71,42 @@ class MatomoApiTrackingMiddleware:
         if any(p for p in ignore_paths if request.path.startswith(p)):
             return response
 
-        try:
-            if (response.content[:100].lower().find(b"<html>") >= 0 or
-                    response.accepted_media_type == "text/html"):
-                title = BeautifulSoup(
-                    response.content, "html.parser").html.head.title.text
-            else:
-                title = None
-        except AttributeError:
-            title = None
+        # drop crawlers and health checks before doing any tracking work
+        bot_filter = get_bot_filter(config)
+        if bot_filter is not None and bot_filter.should_drop(request):
+            return response
 
         referer = request.META.get('HTTP_REFERER', None)
         user_id = None
         if hasattr(request, "user") and getattr(request.user, "is_authenticated", False):
             user_id = getattr(request.user, 'id', None)
 
-        data = build_api_params(
-            request, account, path=request.path, referer=referer, title=title, user_id=user_id)
-        params, meta = data['matomo_params'], data['meta']
+        host = request.get_host()
+        route = resolve_site(host, config)
+        # extracted right away, so a deferred call does not keep the page alive
+        title = get_title(get_html_content(response))
+
+        if config.get('deferred', False):
+            # only take a snapshot now, the rest runs after the response is returned
+            snapshot = RequestSnapshot(request, host)
+            response = set_cookie({'visitor_id': snapshot.visitor_id}, response)
+            submit(self.track, snapshot, route, host, title, referer, user_id)
+            return response
+
+        meta = self.track(request, route, host, title, referer, user_id)
         response = set_cookie(meta, response)
+        return response
+
+    def track(self, request, route, host, title, referer, user_id):
+        """Build the tracking parameters of a request and hand them to the backend."""
+        params, meta = get_param_builder().build(
+            request, route.site_id, path=request.path, referer=referer, title=title,
+            user_id=user_id, host=host, send_cip=route.token_auth is not None)
+        if route.name is not None:
+            meta['site'] = route.name
+        priority = get_priority_table().resolve(request.path)
+        if priority != 'default':
+            meta['priority'] = priority
         backend = get_backend()
         backend.send(params, meta)
-
-        return response
+        return meta
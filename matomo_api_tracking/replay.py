@@ -0,0 +1,254 @@
+"""
+Replay of web server access logs into the Matomo bulk tracking API.
+
+The log files are streamed line by line through a chain of generators, so
+memory use does not depend on the size of the files. Events are built with
+the same ``ParamBuilder`` as used by the middleware and sent in chunks, with
+a bounded number of bulk requests in flight. The line ranges of the chunks
+that were sent are stored in a checkpoint, so that no line is sent twice.
+"""
+import gzip
+import json
+import os
+import re
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from urllib.parse import urljoin
+
+from django.conf import settings
+
+from .bots import get_bot_filter
+from .routing import get_route_table
+from .transport import send_bulk_tracking_events
+from .utils import get_param_builder
+
+# nginx/apache "combined" format, optionally followed by more fields
+COMBINED_LOG_FORMAT = (
+    r'^(?P<ip>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] '
+    r'"(?P<method>[A-Z]+) (?P<path>\S+)[^"]*" (?P<status>\d{3}) \S+'
+    r'(?: "(?P<referer>[^"]*)" "(?P<ua>[^"]*)")?'
+)
+TIME_FORMAT = "%d/%b/%Y:%H:%M:%S %z"
+# status code prefixes of the tracked lines: successful responses and redirects
+STATUSES = ("2", "3")
+# static assets, never tracked as page views
+ASSET_EXTENSIONS = (
+    ".css", ".js", ".map", ".json", ".xml", ".txt", ".ico", ".png", ".jpg", ".jpeg",
+    ".gif", ".svg", ".webp", ".avif", ".woff", ".woff2", ".ttf", ".eot", ".otf",
+    ".mp4", ".webm", ".mp3", ".pdf", ".zip", ".gz",
+)
+
+
+class LogRequest:
+    """Request-like view of an access log entry for the ``ParamBuilder``."""
+
+    def __init__(self, host, scheme, path, client_ip, user_agent):
+        self.host = host
+        self.scheme = scheme
+        self.path = path
+        self.META = {"REMOTE_ADDR": client_ip}
+        if user_agent:
+            self.META["HTTP_USER_AGENT"] = user_agent
+        self.GET = {}
+        self.COOKIES = {}
+
+    def get_host(self):
+        return self.host
+
+    def build_absolute_uri(self, location):
+        return urljoin("{}://{}{}".format(self.scheme, self.host, self.path), location)
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "rt", encoding="utf-8", errors="replace")
+
+
+def read_lines(path, skip=()):
+    """Yield ``(line number, line)`` of a log file, except for the ``[first, last]`` ranges in ``skip``."""
+    ranges = iter(sorted(skip))
+    current = next(ranges, None)
+    with open_log(path) as fh:
+        for number, line in enumerate(fh, 1):
+            while current is not None and number > current[1]:
+                current = next(ranges, None)
+            if current is None or number < current[0]:
+                yield number, line
+
+
+def parse_lines(lines, pattern=COMBINED_LOG_FORMAT, time_format=TIME_FORMAT, methods=("GET",),
+                statuses=STATUSES):
+    """Yield ``(line number, entry dict)`` for all lines matching ``pattern``.
+
+    ``statuses`` are prefixes of the status codes to keep (``"2"`` for all
+    2xx codes, ``"404"`` for a single code). Lines that do not match, have
+    an invalid time, or use another method or status, yield ``None`` as
+    entry so that the line still counts for the checkpoint.
+    """
+    regex = re.compile(pattern)
+    for number, line in lines:
+        match = regex.match(line)
+        entry = None
+        if match and match.group("method") in methods:
+            entry = match.groupdict()
+            status = entry.get("status")
+            try:
+                if status and not status.startswith(statuses):
+                    entry = None
+                else:
+                    entry["timestamp"] = int(datetime.strptime(entry["time"], time_format).timestamp())
+            except ValueError:
+                entry = None
+        yield number, entry
+
+
+def build_events(entries, host, scheme="https", config=None, exclude_paths=(),
+                 exclude_extensions=ASSET_EXTENSIONS):
+    """Yield ``(line number, route, event)``; event is None for skipped lines.
+
+    Besides the ``ignore_paths`` of the config, paths starting with one of
+    ``exclude_paths`` or ending with one of ``exclude_extensions`` are skipped.
+    """
+    if config is None:
+        config = settings.MATOMO_API_TRACKING
+    builder = get_param_builder()
+    routes = get_route_table(config)
+    bot_filter = get_bot_filter(config)
+    ignore_paths = tuple(config.get("ignore_paths", ())) + tuple(exclude_paths)
+    exclude_extensions = tuple(e.lower() for e in exclude_extensions)
+    for number, entry in entries:
+        if entry is None:
+            yield number, None, None
+            continue
+        path = entry["path"].split("?", 1)[0]
+        entry_host = entry.get("host") or host
+        request = LogRequest(entry_host, scheme, path, entry["ip"], entry.get("ua"))
+        if (ignore_paths and path.startswith(ignore_paths)) or (
+                exclude_extensions and path.lower().endswith(exclude_extensions)) or (
+                bot_filter is not None and bot_filter.should_drop(request)):
+            yield number, None, None
+            continue
+        route = routes.resolve(entry_host)
+        referer = entry.get("referer")
+        params, meta = builder.build(
+            request, route.site_id, path=path,
+            referer=None if referer == "-" else referer,
+            custom_params={"cdt": entry["timestamp"]}, host=entry_host,
+            send_cip=route.token_auth is not None)
+        yield number, route, {"params": params, "meta": meta}
+
+
+def chunk_events(events, size):
+    """Group events into chunks of ``size`` events.
+
+    Yields ``(first line number, last line number, {route: [events]})``, the
+    line range covers all lines of the chunk, including skipped ones.
+    """
+    chunk, count, first, last = {}, 0, None, None
+    for number, route, event in events:
+        if first is None:
+            first = number
+        last = number
+        if event is None:
+            continue
+        chunk.setdefault(route, []).append(event)
+        count += 1
+        if count >= size:
+            yield first, last, chunk
+            chunk, count, first = {}, 0, None
+    if first is not None:
+        yield first, last, chunk
+
+
+class Checkpoint:
+    """The ``[first, last]`` line ranges of each log file that were sent, stored as JSON."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = {}
+        if path and os.path.exists(path):
+            with open(path) as fh:
+                self.lines = json.load(fh)
+
+    def get(self, log_path):
+        ranges = self.lines.get(os.path.abspath(log_path), [])
+        if isinstance(ranges, int):
+            # number of lines sent, as stored by earlier versions
+            ranges = [[1, ranges]] if ranges else []
+        return ranges
+
+    def add(self, log_path, first, last):
+        """Record the lines ``first`` to ``last`` as sent."""
+        ranges = []
+        for start, end in sorted(self.get(log_path) + [[first, last]]):
+            if ranges and start <= ranges[-1][1] + 1:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+        self.lines[os.path.abspath(log_path)] = ranges
+        if self.path:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as fh:
+                json.dump(self.lines, fh)
+            os.replace(tmp_path, self.path)
+
+
+def send_chunk(chunk, timeout, retries):
+    for route, events in chunk.items():
+        for attempt in range(retries + 1):
+            if send_bulk_tracking_events(events, route.url, route.token_auth, timeout):
+                break
+            if attempt == retries:
+                return False
+            time.sleep(2 ** attempt)
+    return True
+
+
+def replay(log_path, host, checkpoint, scheme="https", chunk_size=500, concurrency=4,
+           retries=3, pattern=COMBINED_LOG_FORMAT, time_format=TIME_FORMAT, methods=("GET",),
+           statuses=STATUSES, exclude_paths=(), exclude_extensions=ASSET_EXTENSIONS):
+    """Send the entries of ``log_path`` to Matomo, skipping the lines in ``checkpoint``.
+
+    At most ``concurrency`` chunks are in flight, each is added to the
+    checkpoint once it was sent. After a chunk failed, no further chunks are
+    started, but the ones in flight are completed and recorded, so a resumed
+    replay does not send them again. Returns the number of events sent;
+    raises if a chunk could not be sent.
+    """
+    config = settings.MATOMO_API_TRACKING
+    timeout = float(config.get("timeout", 8))
+    lines = read_lines(log_path, checkpoint.get(log_path))
+    entries = parse_lines(lines, pattern, time_format, methods, statuses)
+    chunks = chunk_events(
+        build_events(entries, host, scheme, config, exclude_paths, exclude_extensions),
+        chunk_size)
+
+    sent = 0
+    failed = []
+    running = {}
+
+    def collect(futures):
+        nonlocal sent
+        for future in futures:
+            first, last, count = running.pop(future)
+            if future.exception() is None and future.result():
+                sent += count
+                checkpoint.add(log_path, first, last)
+            else:
+                failed.append(first)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for first, last, chunk in chunks:
+            count = sum(len(events) for events in chunk.values())
+            running[executor.submit(send_chunk, chunk, timeout, retries)] = (first, last, count)
+            collect([future for future in running if future.done()])
+            if len(running) >= concurrency:
+                collect(wait(running, return_when=FIRST_COMPLETED).done)
+            if failed:
+                break
+        collect(wait(running).done)
+    if failed:
+        raise Exception("Matomo bulk tracking failed for the chunk starting at line {}".format(min(failed)))
+    return sent
@@ -0,0 +1,109 @@
+from typing import NamedTuple, Optional
+
+from .utils import cached_for_config
+
+
+class SiteRoute(NamedTuple):
+    """Destination of a tracking event: Matomo site and server."""
+    name: Optional[str]
+    site_id: object
+    url: str
+    token_auth: Optional[str]
+    flush_queue: Optional[str] = None
+
+
+class RouteTable:
+    """Host to Matomo site/server mapping built from ``MATOMO_API_TRACKING``.
+
+    The top level ``site_id``, ``url`` and ``token_auth`` form the default
+    route (``name`` is ``None``). Additional hosts can be mapped with the
+    ``sites`` setting, either to a plain site id or to a dict with
+    ``site_id`` and optionally ``url``, ``token_auth`` and ``flush_queue``
+    (the Celery queue of the site's flush tasks).
+    """
+
+    def __init__(self, config):
+        token = config.get("token_auth", config.get("TOKEN_AUTH"))
+        self.default = SiteRoute(None, config.get("site_id"), config.get("url"), token)
+        self.routes = {}
+        for host, site in config.get("sites", {}).items():
+            if not isinstance(site, dict):
+                site = {"site_id": site}
+            url = site.get("url", self.default.url)
+            # never hand the default token to a different Matomo server
+            inherited_token = self.default.token_auth if url == self.default.url else None
+            name = host.lower()
+            self.routes[name] = SiteRoute(
+                name, site["site_id"], url, site.get("token_auth", inherited_token),
+                site.get("flush_queue"))
+
+    def resolve(self, host):
+        """Return the route for a request host, with or without port."""
+        host = host.lower()
+        route = self.routes.get(host)
+        if route is None and not host.endswith("]"):
+            route = self.routes.get(host.rsplit(":", 1)[0])
+        return route or self.default
+
+    def get(self, name):
+        """Return the route registered under ``name`` (``None`` is the default)."""
+        if name is None:
+            return self.default
+        return self.routes[name]
+
+    def names(self):
+        return list(self.routes)
+
+
+@cached_for_config
+def get_route_table(config):
+    """Return the (cached) route table for the given tracking config."""
+    return RouteTable(config)
+
+
+def resolve_site(host, config=None):
+    return get_route_table(config).resolve(host)
+
+
+DEFAULT_PRIORITY_WEIGHTS = {"high": 4, "default": 2, "low": 1}
+
+
+class PriorityTable:
+    """Priority lanes from the ``priority_paths`` and ``priority_weights`` settings.
+
+    ``priority_paths`` maps path prefixes to lane names, the longest matching
+    prefix wins. Requests on other paths use the ``default`` lane.
+    """
+
+    def __init__(self, config):
+        paths = config.get("priority_paths", {})
+        self.prefixes = sorted(paths.items(), key=lambda item: len(item[0]), reverse=True)
+        weights = dict(DEFAULT_PRIORITY_WEIGHTS, **config.get("priority_weights", {}))
+        names = {"default"} | set(paths.values())
+        self.weights = {name: weights.get(name, 1) for name in names}
+
+    def resolve(self, path):
+        for prefix, lane in self.prefixes:
+            if path.startswith(prefix):
+                return lane
+        return "default"
+
+    def lanes(self):
+        """Lane names, ordered from the highest to the lowest weight."""
+        return sorted(self.weights, key=lambda name: (-self.weights[name], name))
+
+
+@cached_for_config
+def get_priority_table(config):
+    """Return the (cached) priority lanes for the given tracking config."""
+    return PriorityTable(config)
+
+
+def queue_key(base, site=None, priority=None):
+    """Name of the Redis list holding the events of ``site`` and priority lane."""
+    parts = [base]
+    if site is not None:
+        parts.append(site)
+    if priority is not None and priority != "default":
+        parts.append(priority)
+    return ":".join(parts)
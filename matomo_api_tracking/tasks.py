@@ -2,56 +2,127 @@ import logging
 import json
 from celery import shared_task
 from django.conf import settings
-
-try:
-    import redis
-except ImportError:
-    redis = None
-from .transport import send_single_tracking_event, send_bulk_tracking_events
+from .aggregation import release_closed_windows
+from .connections import get_redis, require_redis
+from .routing import get_priority_table, get_route_table, queue_key
 
 logger = logging.getLogger(__name__)
 
 
 @shared_task
-def send_matomo_tracking(params, meta, matomo_url, timeout):
-    return send_single_tracking_event(params, meta, matomo_url, timeout)
+def send_matomo_tracking(params, meta, matomo_url, timeout, token_auth=None):
+    # transport (and requests) are only needed by the workers, not by the web processes
+    from .transport import send_single_tracking_event
+    return send_single_tracking_event(params, meta, matomo_url, timeout, token_auth)
 
 
 @shared_task
-def flush_matomo_batch(batch_size=500):
+def flush_matomo_batch(batch_size=500, site=None):
     """
     Flush Redis-stored Matomo events in batches.
+
+    Without a ``site``, the events of the default site are flushed and a
+    separate flush task is queued for every host configured in ``sites``
+    (on the site's ``flush_queue``, if set), so that a slow or failing
+    Matomo server only delays its own tenant. A site is skipped while a
+    previous flush of it is still running.
     """
-    if redis is None:
-        raise Exception("Redis not installed")
+    require_redis()
 
     config = settings.MATOMO_API_TRACKING
     redis_url = config.get("redis_url")
-    matomo_url = config.get('url')
+    routes = get_route_table(config)
+    try:
+        route = routes.get(site)
+    except KeyError:
+        logger.warning("Matomo site %s is no longer configured, flush skipped.", site)
+        return
 
-    if not redis_url or not matomo_url:
+    if not redis_url or not route.url:
         raise Exception("Matomo configuration incomplete")
 
-    r = redis.Redis.from_url(redis_url)
-    key = config.get("redis_key", "matomo_events")
-    token_auth = config.get("TOKEN_AUTH")
+    if site is None:
+        _queue_site_flushes(routes, batch_size)
+
+    r = get_redis(redis_url)
+    base_key = queue_key(config.get("redis_key", "matomo_events"), site)
     try:
         timeout = float(config.get("timeout", 8))
     except ValueError:
         timeout = 8
 
-    events = []
-    for _ in range(batch_size):
-        item = r.lpop(key)
-        if not item:
-            break
-        events.append(json.loads(item))
+    lock = r.lock(base_key + ":flush_lock", timeout=timeout * 2 + 10)
+    if not lock.acquire(blocking=False):
+        logger.debug("Matomo flush of %s still running, skipped.", base_key)
+        return
+    try:
+        _flush_lanes(r, config, route, site, batch_size, timeout)
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            # the lock expired, e.g. because the flush took longer than its timeout
+            logger.warning("Matomo flush lock of %s expired before the flush finished.", base_key)
+
+
+def _queue_site_flushes(routes, batch_size):
+    for name in routes.names():
+        flush_queue = routes.get(name).flush_queue
+        if flush_queue:
+            flush_matomo_batch.apply_async((batch_size,), {"site": name}, queue=flush_queue)
+        else:
+            flush_matomo_batch.delay(batch_size, site=name)
+
 
+def _flush_lanes(r, config, route, site, batch_size, timeout):
+    base_key = config.get("redis_key", "matomo_events")
+    priorities = get_priority_table(config)
+    lanes = [(queue_key(base_key, site, lane), priorities.weights[lane]) for lane in priorities.lanes()]
+
+    if config.get("aggregate_paths"):
+        for key, _ in lanes:
+            release_closed_windows(r, key, config)
+
+    events = pop_weighted(r, lanes, batch_size)
     if not events:
         return
 
-    success = send_bulk_tracking_events(events, matomo_url, token_auth, timeout)
+    from .transport import send_bulk_tracking_events
+    success = send_bulk_tracking_events(
+        [event for _, event in events], route.url, route.token_auth, timeout)
     if not success:
         logger.warning("Matomo tracking failed, events will be pushed back on queue.")
-        for event in events:
-            r.lpush(key, json.dumps(event))
\ No newline at end of file
+        for key, event in events:
+            r.lpush(key, json.dumps(event))
+
+
+def _pop(r, key, count, events):
+    for n in range(count):
+        item = r.lpop(key)
+        if not item:
+            return n
+        events.append((key, json.loads(item)))
+    return count
+
+
+def pop_weighted(r, lanes, batch_size):
+    """
+    Pop up to ``batch_size`` events from the priority lanes ``[(key, weight)]``.
+
+    Every lane first gets a share of the batch proportional to its weight
+    (at least one event). Capacity left over by lanes with fewer events is
+    then filled from the remaining lanes, the highest weight first.
+    Returns a list of ``(key, event)``.
+    """
+    total = sum(weight for _, weight in lanes)
+    events = []
+    busy = []
+    for key, weight in lanes:
+        quota = min(max(batch_size * weight // total, 1), batch_size - len(events))
+        if quota > 0 and _pop(r, key, quota, events) == quota:
+            busy.append(key)
+    for key in busy:
+        if len(events) >= batch_size:
+            break
+        _pop(r, key, batch_size - len(events), events)
+    return events
@@ -1,20 +1,40 @@
 # -*- coding: utf-8 -*-
 import logging
+import threading
 import responses
+import gzip
 import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
 from collections import ChainMap
 from urllib.parse import parse_qs
-from unittest.mock import patch, MagicMock
+from unittest.mock import call, patch, MagicMock
 from requests.exceptions import Timeout
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.http import HttpResponse
 from django.test import TestCase, override_settings
 from django.test.client import Client, RequestFactory
 from django.conf import settings
-from .middleware import MatomoApiTrackingMiddleware
-from .utils import COOKIE_NAME, build_api_params
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from .middleware import MatomoApiTrackingMiddleware, get_title
+from .utils import COOKIE_NAME, DropCounter, build_api_params, get_param_builder
 from .transport import logger as transport_logger
-from .backends.redis_batch import RedisBatchTrackingBackend
+from .backends.redis_batch import MicroBatcher, RedisBatchTrackingBackend
+from .routing import PriorityTable, get_route_table, queue_key
+from .tasks import pop_weighted
+from .backends.celery import CeleryTrackingBackend
+from .connections import get_redis
+from .dispatcher import get_backend
+from .bots import BotFilter
+from . import deferred
+from .aggregation import release_closed_windows, summarize
+from .loadtest import StubMatomoServer, run_load_test
+from .transport import send_bulk_tracking_events
 
 
 class MatomoTestCase(TestCase):
@@ -162,6 +182,29 @@ class MatomoTestCase(TestCase):
         self.assertEqual(
             api_dict_with_custom['matomo_params'].get('key'), 'value')
 
+    def test_param_builder_caches_language_and_url_prefix(self):
+        builder = get_param_builder()
+        builder.resolve_language.cache_clear()
+        builder.url_prefix.cache_clear()
+        headers = {'HTTP_ACCEPT_LANGUAGE': 'de-CH,de;q=0.9', 'HTTP_HOST': 'localhost'}
+        for _ in range(3):
+            params, meta = builder.build(self.make_fake_request('/somewhere/', headers), 1, path='/ü/')
+
+        self.assertEqual(params['url'], 'http://localhost/%C3%BC/')
+        self.assertEqual(params['lang'], 'de')
+        self.assertEqual(meta['language'], 'de')
+        self.assertEqual(builder.resolve_language.cache_info().hits, 2)
+        self.assertEqual(builder.resolve_language.cache_info().misses, 1)
+        self.assertEqual(builder.url_prefix.cache_info().hits, 2)
+        self.assertEqual(builder.url_prefix.cache_info().misses, 1)
+
+    def test_param_builder_follows_settings(self):
+        request = self.make_fake_request('/somewhere/')
+        self.assertNotIn('cip', get_param_builder().build(request, 1)[0])
+        with self.settings(MATOMO_API_TRACKING=ChainMap({'token_auth': 'abc'}, settings.MATOMO_API_TRACKING)):
+            params, _ = get_param_builder().build(request, 1)
+        self.assertEqual(params['cip'], '127.0.0.1')
+
     @override_settings(MIDDLEWARE=[
         'django.contrib.sessions.middleware.SessionMiddleware',
         'matomo_api_tracking.middleware.MatomoApiTrackingMiddleware'
@@ -237,6 +280,60 @@ class MatomoTestCase(TestCase):
         middleware(request)
         self.assertEqual(len(responses.calls), 0)
 
+    @override_settings(MATOMO_API_TRACKING=ChainMap({'deferred': True},
+                                                    settings.MATOMO_API_TRACKING))
+    @responses.activate
+    def test_matomo_middleware_deferred(self):
+        responses.add(
+            responses.GET, settings.MATOMO_API_TRACKING['url'],
+            body='',
+            status=200)
+        request = self.make_fake_request('/somewhere/?r=http://example.com/', {
+            'HTTP_X_FORWARDED_FOR': '203.0.113.7, 10.0.0.1'})
+        html = "<html><head><title>deferred</title></head></html>"
+        middleware = MatomoApiTrackingMiddleware(lambda req: HttpResponse(html))
+        with patch.object(middleware, 'track', wraps=middleware.track) as track:
+            response = middleware(request)
+            uid = response.cookies.get(COOKIE_NAME).value
+            deferred.shutdown(wait=True)
+        self.assertIsNot(track.call_args[0][0], request)
+        # only the title is kept for the deferred call, not the page
+        self.assertEqual(track.call_args[0][3], 'deferred')
+
+        self.assertEqual(len(responses.calls), 1)
+        track_url = responses.calls[0].request.url
+        self.assertEqual(parse_qs(track_url).get('_id'), [uid])
+        self.assertEqual(parse_qs(track_url).get('action_name'), ['deferred'])
+        self.assertEqual(parse_qs(track_url).get('urlref'), ['http://example.com/'])
+        self.assertEqual(parse_qs(track_url).get('url'), ['http://testserver/somewhere/'])
+
+    def test_get_title_only_parses_head_title(self):
+        page = (b"<html><head><meta charset='utf-8'><title>Caf&eacute;</title></head><body>" +
+                b"<p>x</p>" * 10000 + b"<svg><title>icon</title></svg></body></html>")
+        self.assertEqual(get_title(page), 'Caf\xe9')
+        self.assertIsNone(get_title(b"<html><head></head><body><svg><title>icon</title></svg></body></html>"))
+        self.assertIsNone(get_title(b"<html><header><title>x</title></header></html>"))
+
+    @override_settings(MATOMO_API_TRACKING=ChainMap({'filter_bots': True},
+                                                    settings.MATOMO_API_TRACKING))
+    @responses.activate
+    def test_matomo_middleware_drops_bots(self):
+        responses.add(
+            responses.GET, settings.MATOMO_API_TRACKING['url'],
+            body='',
+            status=200)
+        middleware = MatomoApiTrackingMiddleware(lambda req: HttpResponse())
+        bot = self.make_fake_request('/somewhere/', {
+            'HTTP_USER_AGENT': 'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'})
+        response = middleware(bot)
+        self.assertEqual(len(responses.calls), 0)
+        self.assertIsNone(response.cookies.get(COOKIE_NAME))
+
+        browser = self.make_fake_request('/somewhere/', {
+            'HTTP_USER_AGENT': 'Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0'})
+        middleware(browser)
+        self.assertEqual(len(responses.calls), 1)
+
     @override_settings(MIDDLEWARE=[
         'django.contrib.sessions.middleware.SessionMiddleware',
         'matomo_api_tracking.middleware.MatomoApiTrackingMiddleware'
@@ -281,6 +378,44 @@ class MatomoTestCase(TestCase):
         self.assertIn("Matomo tracking failed", cm.output[0])
         self.assertIn("Bad Request", cm.output[0])
 
+    @override_settings(MATOMO_API_TRACKING=ChainMap({
+        'sites': {'shop.example.com': {'site_id': 7, 'url': 'https://stats.example.com/matomo.php'}},
+    }, settings.MATOMO_API_TRACKING), ALLOWED_HOSTS=['shop.example.com', 'testserver'])
+    @responses.activate
+    def test_matomo_middleware_routes_host_to_site(self):
+        responses.add(responses.GET, 'https://stats.example.com/matomo.php', body='', status=200)
+        request = self.make_fake_request('/somewhere/', {'HTTP_HOST': 'shop.example.com'})
+        middleware = MatomoApiTrackingMiddleware(lambda req: HttpResponse())
+        middleware(request)
+
+        self.assertEqual(len(responses.calls), 1)
+        track_url = responses.calls[0].request.url
+        self.assertTrue(track_url.startswith('https://stats.example.com/matomo.php'))
+        self.assertEqual(parse_qs(track_url).get('idsite'), ['7'])
+
+    @override_settings(MATOMO_API_TRACKING=ChainMap({
+        'token_auth': 'secret',
+        'sites': {
+            'shop.example.com': {'site_id': 7, 'url': 'https://stats.example.com/matomo.php'},
+            'blog.example.com': {'site_id': 8, 'url': 'https://blog-stats.example.com/matomo.php',
+                                 'token_auth': 'blog-secret'},
+        },
+    }, settings.MATOMO_API_TRACKING), ALLOWED_HOSTS=['shop.example.com', 'blog.example.com', 'testserver'])
+    @responses.activate
+    def test_matomo_middleware_sends_cip_per_site_token(self):
+        responses.add(responses.GET, 'https://stats.example.com/matomo.php', body='', status=200)
+        responses.add(responses.GET, 'https://blog-stats.example.com/matomo.php', body='', status=200)
+        middleware = MatomoApiTrackingMiddleware(lambda req: HttpResponse())
+        middleware(self.make_fake_request('/somewhere/', {'HTTP_HOST': 'shop.example.com'}))
+        middleware(self.make_fake_request('/somewhere/', {'HTTP_HOST': 'blog.example.com'}))
+
+        shop_params = parse_qs(responses.calls[0].request.url)
+        blog_params = parse_qs(responses.calls[1].request.url)
+        self.assertIsNone(shop_params.get('cip'))
+        self.assertIsNone(shop_params.get('token_auth'))
+        self.assertEqual(blog_params.get('cip'), ['127.0.0.1'])
+        self.assertEqual(blog_params.get('token_auth'), ['blog-secret'])
+
     @patch('matomo_api_tracking.transport.logger')
     @patch('matomo_api_tracking.transport.requests.get')
     def test_send_matomo_tracking_logs_timeout(self, mock_get, mock_logger):
@@ -296,9 +431,194 @@ class MatomoTestCase(TestCase):
         self.assertTrue(mock_logger.warning.called)
 
 
+class BotFilterTests(TestCase):
+
+    def test_signatures_and_verdict_cache(self):
+        bot_filter = BotFilter(('bot', 'kube-probe'))
+        self.assertTrue(bot_filter.is_bot('kube-probe/1.29'))
+        self.assertTrue(bot_filter.is_bot('Mozilla/5.0 (compatible; bingBOT/2.0)'))
+        self.assertFalse(bot_filter.is_bot('Mozilla/5.0 Firefox/128.0'))
+        self.assertTrue(bot_filter.is_bot('kube-probe/1.29'))
+        self.assertEqual(bot_filter.is_bot.cache_info().hits, 1)
+
+    def test_default_signatures(self):
+        bot_filter = BotFilter()
+        for user_agent in (
+                'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+                'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)',
+                'DuckDuckBot-Https/1.1; (+https://duckduckgo.com/duckduckbot)',
+                'Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)',
+                'Mozilla/5.0+(compatible; UptimeRobot/2.0; http://www.uptimerobot.com/)',
+                'Uptime-Kuma/1.23.11',
+                'ELB-HealthChecker/2.0',
+                'Consul Health Check',
+                'check_http/v2.3.3 (monitoring-plugins 2.3.3)',
+                'kube-probe/1.29'):
+            self.assertTrue(bot_filter.is_bot(user_agent), user_agent)
+
+    def test_browsers_are_not_bots(self):
+        bot_filter = BotFilter()
+        for user_agent in (
+                'Mozilla/5.0 (Linux; Android 11; CUBOT_X30) AppleWebKit/537.36 '
+                '(KHTML, like Gecko) Chrome/120.0.6099.144 Mobile Safari/537.36',
+                'Mozilla/5.0 (Linux; Android 10; CUBOT-X20) AppleWebKit/537.36 '
+                '(KHTML, like Gecko) Chrome/118.0.0.0 Mobile Safari/537.36',
+                'Mozilla/5.0 (Linux; Android 8.1.0; Cubot; KINGKONG 5) AppleWebKit/537.36 '
+                '(KHTML, like Gecko) Chrome/116.0.0.0 Mobile Safari/537.36',
+                'Mozilla/5.0 (Linux; Android 12; Robot-Vacuum Build/SP1A.210812.016; wv) AppleWebKit/537.36 '
+                '(KHTML, like Gecko) Version/4.0 Chrome/120.0.0.0 Safari/537.36',
+                'Mozilla/5.0 (Linux; Android 10; CUBOT NOTE 20 PRO Build/QP1A.190711.020; wv) '
+                'AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/118.0.5993.111 Mobile Safari/537.36',
+                'Mozilla/5.0 (Linux; Android 13; SM-S911B Build/TP1A.220624.014; wv) AppleWebKit/537.36 '
+                '(KHTML, like Gecko) Version/4.0 Chrome/121.0.6167.101 Mobile Safari/537.36 SamsungHealth/6.26',
+                'Mozilla/5.0 (iPhone; CPU iPhone OS 17_2 like Mac OS X) AppleWebKit/605.1.15 '
+                '(KHTML, like Gecko) Mobile/15E148 BabyMonitor/3.4.1',
+                'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:128.0) Gecko/20100101 Firefox/128.0'):
+            self.assertFalse(bot_filter.is_bot(user_agent), user_agent)
+
+    @patch('matomo_api_tracking.bots.random')
+    def test_sampled_bots_are_kept(self, mock_random):
+        request = RequestFactory().get('/', HTTP_USER_AGENT='curl/8.5.0')
+        bot_filter = BotFilter(sample_rate=0.1)
+        mock_random.random.return_value = 0.05
+        self.assertFalse(bot_filter.should_drop(request))
+        mock_random.random.return_value = 0.5
+        self.assertTrue(bot_filter.should_drop(request))
+
+
+class MicroBatcherTests(TestCase):
+
+    def test_events_are_written_in_batches(self):
+        batches = []
+        batcher = MicroBatcher(batches.append, interval=0.05, max_events=3)
+        for i in range(5):
+            batcher.put(i)
+        batcher.flush()
+        self.assertEqual(sum(batches, []), [0, 1, 2, 3, 4])
+        self.assertTrue(all(len(batch) <= 3 for batch in batches))
+        self.assertLess(len(batches), 5)
+
+    def test_full_queue_drops_events(self):
+        release = threading.Event()
+        batcher = MicroBatcher(lambda batch: release.wait(1), interval=0, max_events=1, queue_size=1)
+        with self.assertLogs('matomo_api_tracking.backends.redis_batch', logging.WARNING) as cm:
+            for i in range(5):
+                batcher.put(i)
+        release.set()
+        batcher.flush()
+        # logged once, not for every dropped event
+        self.assertEqual(len(cm.output), 1)
+        self.assertIn("queue full", cm.output[0])
+
+    @patch('matomo_api_tracking.utils.time')
+    def test_drops_are_logged_once_per_interval(self, mock_time):
+        logger = MagicMock()
+        dropped = DropCounter(logger, "queue full", interval=60)
+        for now in (0, 1, 2, 30, 61, 62):
+            mock_time.monotonic.return_value = now
+            dropped.add()
+        self.assertEqual(logger.warning.call_args_list, [
+            call("%s, dropped %d tracking events.", "queue full", 1),
+            call("%s, dropped %d tracking events.", "queue full", 4),
+        ])
+
+    def test_flush_gives_up_after_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        batcher = MicroBatcher(lambda batch: release.wait(5), interval=0, max_events=1)
+        for i in range(3):
+            batcher.put(i)
+        start = time.monotonic()
+        with self.assertLogs('matomo_api_tracking.backends.redis_batch', logging.WARNING) as cm:
+            batcher.flush(timeout=0.2)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIn("flush timed out", cm.output[-1])
+
+
+class RouteTableTests(TestCase):
+
+    def setUp(self):
+        self.table = get_route_table({
+            'url': 'https://matomo.example.com/matomo.php',
+            'site_id': 1,
+            'token_auth': 'secret',
+            'sites': {
+                'Blog.example.com': 2,
+                'shop.example.com:8443': {'site_id': 3, 'url': 'https://other.example.com/matomo.php'},
+            },
+        })
+
+    def test_table_is_cached_per_config_object(self):
+        config = {'url': 'https://matomo.example.com/matomo.php', 'site_id': 1}
+        table = get_route_table(config)
+        self.assertIs(get_route_table(config), table)
+        self.assertIsNot(get_route_table(dict(config)), table)
+        self.assertIs(get_route_table(), get_route_table(settings.MATOMO_API_TRACKING))
+
+    def test_unknown_host_uses_default_route(self):
+        route = self.table.resolve('www.example.com')
+        self.assertIsNone(route.name)
+        self.assertEqual(route.site_id, 1)
+
+    def test_host_lookup_ignores_case_and_port(self):
+        route = self.table.resolve('blog.EXAMPLE.com:8000')
+        self.assertEqual(route.name, 'blog.example.com')
+        self.assertEqual(route.site_id, 2)
+        self.assertEqual(route.token_auth, 'secret')
+
+    def test_token_not_shared_with_other_server(self):
+        route = self.table.resolve('shop.example.com:8443')
+        self.assertEqual(route.url, 'https://other.example.com/matomo.php')
+        self.assertIsNone(route.token_auth)
+
+
+class PriorityLaneTests(TestCase):
+
+    def test_longest_prefix_selects_lane(self):
+        table = PriorityTable({'priority_paths': {'/api/': 'low', '/api/checkout/': 'high'}})
+        self.assertEqual(table.resolve('/api/items/'), 'low')
+        self.assertEqual(table.resolve('/api/checkout/pay/'), 'high')
+        self.assertEqual(table.resolve('/about/'), 'default')
+        self.assertEqual(table.lanes(), ['high', 'default', 'low'])
+        self.assertEqual(queue_key('events', None, 'low'), 'events:low')
+        self.assertEqual(queue_key('events', 'shop.example.com', 'default'), 'events:shop.example.com')
+
+    def test_pop_weighted_shares_batch(self):
+        queues = {
+            'high': [json.dumps({'n': i}) for i in range(2)],
+            'low': [json.dumps({'n': i}) for i in range(100)],
+        }
+        r = MagicMock()
+        r.lpop.side_effect = lambda key: queues[key].pop(0) if queues[key] else None
+
+        events = pop_weighted(r, [('high', 3), ('low', 1)], 8)
+        self.assertEqual([key for key, _ in events].count('high'), 2)
+        self.assertEqual(len(events), 8)
+
+        queues['high'] = [json.dumps({'n': i}) for i in range(100)]
+        events = pop_weighted(r, [('high', 3), ('low', 1)], 8)
+        self.assertEqual([key for key, _ in events].count('high'), 6)
+        self.assertEqual([key for key, _ in events].count('low'), 2)
+
+    @patch('matomo_api_tracking.backends.celery.send_matomo_tracking')
+    def test_celery_backend_uses_lane_queue(self, mock_task):
+        with self.settings(MATOMO_API_TRACKING=ChainMap(
+                {'priority_queues': {'low': 'matomo_low'}}, settings.MATOMO_API_TRACKING)):
+            backend = CeleryTrackingBackend()
+        backend.send({'a': 1}, {'priority': 'low'})
+        self.assertEqual(mock_task.apply_async.call_args[1], {'queue': 'matomo_low'})
+        backend.send({'a': 1}, {})
+        mock_task.delay.assert_called_once()
+
+
 class RedisBatchTrackingBackendTests(TestCase):
 
-    @patch('matomo_api_tracking.backends.redis_batch.redis')
+    def setUp(self):
+        patcher = patch.dict('matomo_api_tracking.connections._clients', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('matomo_api_tracking.connections.redis')
     @patch('matomo_api_tracking.backends.redis_batch.settings')
     def test_send_pushes_to_redis_list(self, mock_settings, mock_redis_module):
         # Fake settings
@@ -309,7 +629,7 @@ class RedisBatchTrackingBackendTests(TestCase):
 
         # Fake Redis connection and instance
         mock_redis_instance = MagicMock()
-        mock_redis_module.Redis.from_url.return_value = mock_redis_instance
+        mock_redis_module.Redis.return_value = mock_redis_instance
 
         backend = RedisBatchTrackingBackend()
         params = {'foo': 'bar'}
@@ -324,13 +644,45 @@ class RedisBatchTrackingBackendTests(TestCase):
         self.assertEqual(loaded['params'], params)
         self.assertEqual(loaded['meta'], meta)
 
-    @patch('matomo_api_tracking.backends.redis_batch.redis', None)
+    @patch('matomo_api_tracking.connections.redis')
+    @patch('matomo_api_tracking.backends.redis_batch.settings')
+    def test_send_logs_redis_errors(self, mock_settings, mock_redis_module):
+        mock_settings.MATOMO_API_TRACKING = {'redis_url': 'redis://localhost:6379/0'}
+        mock_redis_module.Redis.return_value.rpush.side_effect = Exception("Too many connections")
+
+        backend = RedisBatchTrackingBackend()
+        with self.assertLogs('matomo_api_tracking.backends.redis_batch', logging.ERROR) as cm:
+            backend.send({'foo': 'bar'}, {})
+        self.assertIn("Too many connections", cm.output[0])
+        # the request path uses a pool that does not wait for free connections
+        mock_redis_module.ConnectionPool.from_url.assert_called_once()
+        mock_redis_module.BlockingConnectionPool.from_url.assert_not_called()
+
+    def test_send_returns_when_redis_stalls(self):
+        # accepts connections, but never replies
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(8)
+        config = ChainMap({
+            'redis_url': 'redis://127.0.0.1:{}/0'.format(listener.getsockname()[1]),
+            'redis_socket_timeout': 0.2,
+        }, settings.MATOMO_API_TRACKING)
+
+        with self.settings(MATOMO_API_TRACKING=config):
+            backend = RedisBatchTrackingBackend()
+            start = time.monotonic()
+            with self.assertLogs('matomo_api_tracking.backends.redis_batch', logging.ERROR):
+                backend.send({'foo': 'bar'}, {})
+        self.assertLess(time.monotonic() - start, 2)
+
+    @patch('matomo_api_tracking.connections.redis', None)
     def test_raises_if_redis_not_installed(self):
         with self.assertRaises(Exception) as cm:
             RedisBatchTrackingBackend()
         self.assertIn("Redis not installed", str(cm.exception))
 
-    @patch('matomo_api_tracking.backends.redis_batch.redis')
+    @patch('matomo_api_tracking.connections.redis')
     @patch('matomo_api_tracking.backends.redis_batch.settings')
     def test_key_defaults_if_not_set(self, mock_settings, mock_redis_module):
         # No redis_key in config
@@ -338,14 +690,116 @@ class RedisBatchTrackingBackendTests(TestCase):
             'redis_url': 'redis://localhost:6379/0',
         }
         mock_redis_instance = MagicMock()
-        mock_redis_module.Redis.from_url.return_value = mock_redis_instance
+        mock_redis_module.Redis.return_value = mock_redis_instance
         backend = RedisBatchTrackingBackend()
         self.assertEqual(backend.key, 'matomo_events')
 
+    @patch('matomo_api_tracking.connections.redis')
+    @patch('matomo_api_tracking.backends.redis_batch.settings')
+    def test_send_aggregates_configured_paths(self, mock_settings, mock_redis_module):
+        mock_settings.MATOMO_API_TRACKING = {
+            'redis_url': 'redis://localhost:6379/0',
+            'aggregate_paths': ['/api/'],
+            'aggregate_window': 60,
+        }
+        mock_redis_instance = MagicMock()
+        mock_redis_module.Redis.return_value = mock_redis_instance
+        backend = RedisBatchTrackingBackend()
+
+        backend.send({'url': 'http://testserver/page/', '_id': 'a', 'cdt': 120}, {})
+        backend.send({'url': 'http://testserver/api/items/', '_id': 'a', 'cdt': 130}, {})
+
+        mock_redis_instance.rpush.assert_called_once()
+        mock_redis_instance.pipeline.assert_called_once_with(transaction=True)
+        pipe = mock_redis_instance.pipeline.return_value
+        pipe.hincrby.assert_called_once_with(
+            'matomo_events:agg:2:n', json.dumps(['http://testserver/api/items/', 'a']), 1)
+        pipe.zadd.assert_called_once_with('matomo_events:agg', {2: 2})
+
+    @patch('matomo_api_tracking.connections.redis')
+    @patch('matomo_api_tracking.backends.redis_batch.settings')
+    def test_micro_batching_pipelines_rpush(self, mock_settings, mock_redis_module):
+        mock_settings.MATOMO_API_TRACKING = {
+            'redis_url': 'redis://localhost:6379/0',
+            'redis_batch_interval': 0.05,
+        }
+        mock_redis_instance = MagicMock()
+        mock_redis_module.Redis.return_value = mock_redis_instance
+        backend = RedisBatchTrackingBackend()
+        for i in range(3):
+            backend.send({'n': i}, {})
+        backend.batcher.flush()
+
+        mock_redis_instance.rpush.assert_not_called()
+        pipe = mock_redis_instance.pipeline.return_value
+        pushed = [json.loads(v)['params']['n'] for c in pipe.rpush.call_args_list for v in c[0][1:]]
+        self.assertEqual(pushed, [0, 1, 2])
+        self.assertLess(pipe.rpush.call_count, 3)
+
+
+class ProcessLocalConnectionTests(TestCase):
+
+    def setUp(self):
+        patcher = patch.dict('matomo_api_tracking.connections._clients', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('matomo_api_tracking.connections.os')
+    @patch('matomo_api_tracking.connections.redis')
+    def test_redis_client_is_shared_per_process(self, mock_redis_module, mock_os):
+        mock_redis_module.Redis.side_effect = lambda **kwargs: MagicMock()
+        mock_os.getpid.return_value = 100
+        client = get_redis('redis://localhost:6379/0')
+        self.assertIs(get_redis('redis://localhost:6379/0'), client)
+        mock_redis_module.BlockingConnectionPool.from_url.assert_called_once()
+
+        mock_os.getpid.return_value = 101
+        self.assertIsNot(get_redis('redis://localhost:6379/0'), client)
+        self.assertEqual(mock_redis_module.BlockingConnectionPool.from_url.call_count, 2)
+
+    @patch('matomo_api_tracking.dispatcher.os')
+    def test_backend_is_recreated_after_fork(self, mock_os):
+        mock_os.getpid.return_value = 100
+        backend = get_backend()
+        self.assertIs(get_backend(), backend)
+        mock_os.getpid.return_value = 101
+        self.assertIsNot(get_backend(), backend)
+
+
+class AggregationTests(TestCase):
+
+    @patch('matomo_api_tracking.aggregation.time')
+    def test_closed_windows_are_summarized(self, mock_time):
+        mock_time.time.return_value = 200
+        field = json.dumps(['http://testserver/api/', 'a']).encode()
+        event = {'params': {'url': 'http://testserver/api/', '_id': 'a'}, 'meta': {}}
+        r = MagicMock()
+        r.zrangebyscore.return_value = [b'2']
+        r.pipeline.return_value.execute.return_value = (
+            {field: b'42'}, {field: json.dumps(event).encode()}, 2, 1)
+
+        queued = release_closed_windows(r, 'matomo_events', {'aggregate_dimension': 3})
+
+        self.assertEqual(queued, 1)
+        r.zrangebyscore.assert_called_once_with('matomo_events:agg', '-inf', 2)
+        key, summary = r.rpush.call_args[0]
+        self.assertEqual(key, 'matomo_events')
+        self.assertEqual(json.loads(summary)['params']['dimension3'], 42)
+
+    def test_summary_uses_custom_variable_without_dimension(self):
+        summary = summarize({'params': {'url': 'x'}, 'meta': {}}, 5, {})
+        self.assertEqual(json.loads(summary['params']['cvar']), {'1': ['hits', '5']})
+
 
 class FlushMatomoBatchTests(TestCase):
-    @patch('matomo_api_tracking.tasks.redis')
-    @patch('matomo_api_tracking.tasks.send_bulk_tracking_events')
+
+    def setUp(self):
+        patcher = patch.dict('matomo_api_tracking.connections._clients', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('matomo_api_tracking.connections.redis')
+    @patch('matomo_api_tracking.transport.send_bulk_tracking_events')
     @patch('matomo_api_tracking.tasks.settings')
     def test_flushes_events_and_calls_bulk_sender(self, mock_settings, mock_bulk, mock_redis_module):
         # Prepare fake settings and redis
@@ -363,7 +817,7 @@ class FlushMatomoBatchTests(TestCase):
             {'params': {'bar': 3}, 'meta': {'u': 4}},
         ]
         mock_redis_instance.lpop.side_effect = [json.dumps(event_dicts[0]), json.dumps(event_dicts[1]), None]
-        mock_redis_module.Redis.from_url.return_value = mock_redis_instance
+        mock_redis_module.Redis.return_value = mock_redis_instance
 
         # Should indicate success
         mock_bulk.return_value = True
@@ -381,8 +835,8 @@ class FlushMatomoBatchTests(TestCase):
         self.assertEqual(sent_token, 'abc')
         self.assertIsInstance(sent_timeout, float)
 
-    @patch('matomo_api_tracking.tasks.redis')
-    @patch('matomo_api_tracking.tasks.send_bulk_tracking_events')
+    @patch('matomo_api_tracking.connections.redis')
+    @patch('matomo_api_tracking.transport.send_bulk_tracking_events')
     @patch('matomo_api_tracking.tasks.settings')
     def test_if_no_events_it_returns(self, mock_settings, mock_bulk, mock_redis_module):
         mock_settings.MATOMO_API_TRACKING = {
@@ -391,21 +845,95 @@ class FlushMatomoBatchTests(TestCase):
         }
         mock_redis_instance = MagicMock()
         mock_redis_instance.lpop.return_value = None
-        mock_redis_module.Redis.from_url.return_value = mock_redis_instance
+        mock_redis_module.Redis.return_value = mock_redis_instance
 
         from matomo_api_tracking.tasks import flush_matomo_batch
         flush_matomo_batch()
         mock_bulk.assert_not_called()  # No events, so bulk is not called
 
-    @patch('matomo_api_tracking.tasks.redis', None)
+    @patch('matomo_api_tracking.connections.redis')
+    @patch('matomo_api_tracking.transport.send_bulk_tracking_events')
+    @patch('matomo_api_tracking.tasks.settings')
+    def test_flushes_each_site_separately(self, mock_settings, mock_bulk, mock_redis_module):
+        mock_settings.MATOMO_API_TRACKING = {
+            'redis_url': 'redis://localhost/0',
+            'url': 'http://example.com/track',
+            'site_id': 1,
+            'sites': {'shop.example.com': {'site_id': 2, 'url': 'http://other.com/track', 'token_auth': 'xyz'}},
+        }
+        queues = {
+            'matomo_events': [json.dumps({'params': {'idsite': 1}, 'meta': {}})],
+            'matomo_events:shop.example.com': [json.dumps({'params': {'idsite': 2}, 'meta': {}})],
+        }
+        mock_redis_instance = MagicMock()
+        mock_redis_instance.lpop.side_effect = lambda key: queues[key].pop(0) if queues[key] else None
+        mock_redis_module.Redis.return_value = mock_redis_instance
+        mock_bulk.return_value = True
+
+        from matomo_api_tracking.tasks import flush_matomo_batch
+        flush_matomo_batch()
+
+        sent = {call[0][1]: (call[0][0], call[0][2]) for call in mock_bulk.call_args_list}
+        self.assertEqual(sent['http://example.com/track'][0], [{'params': {'idsite': 1}, 'meta': {}}])
+        self.assertEqual(sent['http://other.com/track'], ([{'params': {'idsite': 2}, 'meta': {}}], 'xyz'))
+
+    @patch('matomo_api_tracking.connections.redis')
+    @patch('matomo_api_tracking.transport.send_bulk_tracking_events')
+    @patch('matomo_api_tracking.tasks.settings')
+    def test_site_flushes_use_site_queue(self, mock_settings, mock_bulk, mock_redis_module):
+        mock_settings.MATOMO_API_TRACKING = {
+            'redis_url': 'redis://localhost/0',
+            'url': 'http://example.com/track',
+            'sites': {'shop.example.com': {'site_id': 2, 'flush_queue': 'matomo_shop'}},
+        }
+        mock_redis_module.Redis.return_value.lpop.return_value = None
+
+        from matomo_api_tracking.tasks import flush_matomo_batch
+        with patch.object(flush_matomo_batch, 'apply_async') as mock_apply:
+            flush_matomo_batch(batch_size=10)
+        mock_apply.assert_called_once_with((10,), {'site': 'shop.example.com'}, queue='matomo_shop')
+
+    @patch('matomo_api_tracking.connections.redis')
+    @patch('matomo_api_tracking.transport.send_bulk_tracking_events')
+    @patch('matomo_api_tracking.tasks.settings')
+    def test_skips_site_while_previous_flush_runs(self, mock_settings, mock_bulk, mock_redis_module):
+        mock_settings.MATOMO_API_TRACKING = {
+            'redis_url': 'redis://localhost/0',
+            'url': 'http://example.com/track',
+        }
+        mock_redis_instance = mock_redis_module.Redis.return_value
+        mock_redis_instance.lock.return_value.acquire.return_value = False
+
+        from matomo_api_tracking.tasks import flush_matomo_batch
+        flush_matomo_batch()
+        mock_redis_instance.lock.assert_called_once()
+        self.assertEqual(mock_redis_instance.lock.call_args[0][0], 'matomo_events:flush_lock')
+        mock_redis_instance.lpop.assert_not_called()
+        mock_bulk.assert_not_called()
+
+    @patch('matomo_api_tracking.connections.redis')
+    @patch('matomo_api_tracking.transport.send_bulk_tracking_events')
+    @patch('matomo_api_tracking.tasks.settings')
+    def test_unknown_site_is_skipped(self, mock_settings, mock_bulk, mock_redis_module):
+        mock_settings.MATOMO_API_TRACKING = {
+            'redis_url': 'redis://localhost/0',
+            'url': 'http://example.com/track',
+        }
+        from matomo_api_tracking.tasks import flush_matomo_batch
+        with self.assertLogs('matomo_api_tracking.tasks', logging.WARNING) as cm:
+            flush_matomo_batch(site='removed.example.com')
+        self.assertIn("no longer configured", cm.output[0])
+        mock_bulk.assert_not_called()
+
+    @patch('matomo_api_tracking.connections.redis', None)
     def test_raises_when_no_redis(self):
         from matomo_api_tracking.tasks import flush_matomo_batch
         with self.assertRaises(Exception) as cm:
             flush_matomo_batch()
         self.assertIn("Redis not installed", str(cm.exception))
 
-    @patch('matomo_api_tracking.tasks.redis')
-    @patch('matomo_api_tracking.tasks.send_bulk_tracking_events')
+    @patch('matomo_api_tracking.connections.redis')
+    @patch('matomo_api_tracking.transport.send_bulk_tracking_events')
     @patch('matomo_api_tracking.tasks.settings')
     def test_failed_bulk_requeues_events(self, mock_settings, mock_bulk, mock_redis_module):
         # Prepare minimal config
@@ -417,7 +945,7 @@ class FlushMatomoBatchTests(TestCase):
         mock_redis_instance = MagicMock()
         event_dict = {'params': {'foo': 5}, 'meta': {'bar': 6}}
         mock_redis_instance.lpop.side_effect = [json.dumps(event_dict), None]
-        mock_redis_module.Redis.from_url.return_value = mock_redis_instance
+        mock_redis_module.Redis.return_value = mock_redis_instance
         # Fail the bulk sending
         mock_bulk.return_value = False
 
@@ -434,15 +962,197 @@ class FlushMatomoBatchTests(TestCase):
         # Should requeue the event
         mock_redis_instance.lpush.assert_called_once_with('matomo_events', json.dumps(event_dict))
 
-    @patch('matomo_api_tracking.tasks.redis')
-    @patch('matomo_api_tracking.tasks.send_bulk_tracking_events')
+    @patch('matomo_api_tracking.connections.redis')
+    @patch('matomo_api_tracking.transport.send_bulk_tracking_events')
     @patch('matomo_api_tracking.tasks.settings')
     def test_raises_on_missing_config(self, mock_settings, mock_bulk, mock_redis_module):
         mock_settings.MATOMO_API_TRACKING = {'url': '', 'redis_url': ''}
         mock_redis_instance = MagicMock()
-        mock_redis_module.Redis.from_url.return_value = mock_redis_instance
+        mock_redis_module.Redis.return_value = mock_redis_instance
 
         from matomo_api_tracking.tasks import flush_matomo_batch
         with self.assertRaises(Exception) as cm:
             flush_matomo_batch()
         self.assertIn("Matomo configuration incomplete", str(cm.exception))
+
+
+class MatomoReplayCommandTests(TestCase):
+
+    LOG_LINES = [
+        '203.0.113.7 - - [10/Oct/2025:13:55:36 +0000] "GET /page/?q=1 HTTP/1.1" 200 2326 '
+        '"https://www.example.com/" "Mozilla/5.0 Firefox/128.0"',
+        'garbage',
+        '203.0.113.8 - - [10/Oct/2025:13:55:37 +0000] "POST /form/ HTTP/1.1" 302 0 "-" "Mozilla/5.0"',
+        '203.0.113.9 - - [10/Oct/2025:13:55:38 +0000] "GET /other/ HTTP/1.1" 200 12 "-" "Mozilla/5.0"',
+        '203.0.113.7 - - [10/Oct/2025:13:56:00 +0000] "GET /last/ HTTP/1.1" 200 12 "-" "Mozilla/5.0"',
+    ]
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.log_path = os.path.join(tmpdir.name, 'access.log.gz')
+        self.checkpoint_path = os.path.join(tmpdir.name, 'checkpoint.json')
+        self.write_log(self.LOG_LINES)
+
+    def write_log(self, lines):
+        with gzip.open(self.log_path, 'wt') as fh:
+            fh.write('\n'.join(lines) + '\n')
+
+    def replay(self, *args):
+        call_command(
+            'matomo_replay', self.log_path, '--host', 'www.example.org', '--chunk-size', '2',
+            '--concurrency', '2', '--retries', '0', '--checkpoint', self.checkpoint_path, *args,
+            stdout=MagicMock(), stderr=MagicMock())
+
+    @patch('matomo_api_tracking.replay.send_bulk_tracking_events')
+    def test_replays_log_in_chunks(self, mock_bulk):
+        mock_bulk.return_value = True
+        self.replay()
+
+        sent = [event['params'] for c in mock_bulk.call_args_list for event in c[0][0]]
+        self.assertEqual(mock_bulk.call_count, 2)
+        self.assertEqual([p['url'] for p in sent], [
+            'https://www.example.org/page/', 'https://www.example.org/other/',
+            'https://www.example.org/last/'])
+        self.assertEqual(sent[0]['cdt'], 1760104536)
+        self.assertEqual(sent[0]['urlref'], 'https://www.example.com/')
+        self.assertEqual(sent[0]['ua'], 'Mozilla/5.0 Firefox/128.0')
+        self.assertEqual(sent[0]['_id'], sent[2]['_id'])
+        self.assertEqual(mock_bulk.call_args[0][1], settings.MATOMO_API_TRACKING['url'])
+        with open(self.checkpoint_path) as fh:
+            self.assertEqual(list(json.load(fh).values()), [[[1, 5]]])
+
+    @patch('matomo_api_tracking.replay.send_bulk_tracking_events')
+    def test_resumes_from_checkpoint(self, mock_bulk):
+        mock_bulk.side_effect = lambda events, *args: events[-1]['params']['url'].endswith('/other/')
+        with self.assertRaises(CommandError):
+            self.replay()
+        with open(self.checkpoint_path) as fh:
+            self.assertEqual(list(json.load(fh).values()), [[[1, 4]]])
+
+        mock_bulk.reset_mock(side_effect=True)
+        mock_bulk.return_value = True
+        self.replay()
+        mock_bulk.assert_called_once()
+        self.assertEqual([e['params']['url'] for e in mock_bulk.call_args[0][0]],
+                         ['https://www.example.org/last/'])
+
+    @patch('matomo_api_tracking.replay.send_bulk_tracking_events')
+    def test_chunks_in_flight_are_not_sent_twice(self, mock_bulk):
+        second_sent = threading.Event()
+
+        def send(events, *args):
+            url = events[0]['params']['url']
+            if url.endswith('/page/'):
+                # fails while the next chunk is already in flight
+                second_sent.wait(5)
+                return False
+            second_sent.set()
+            return True
+
+        mock_bulk.side_effect = send
+        with self.assertRaises(CommandError):
+            self.replay('--chunk-size', '1')
+        first_run = [c[0][0][0]['params']['url'] for c in mock_bulk.call_args_list]
+        self.assertIn('https://www.example.org/other/', first_run)
+
+        mock_bulk.reset_mock(side_effect=True)
+        mock_bulk.return_value = True
+        self.replay('--chunk-size', '1')
+        resumed = [c[0][0][0]['params']['url'] for c in mock_bulk.call_args_list]
+        sent = [url for url in first_run if not url.endswith('/page/')] + resumed
+        self.assertEqual(sorted(sent), [
+            'https://www.example.org/last/', 'https://www.example.org/other/',
+            'https://www.example.org/page/'])
+
+    @patch('matomo_api_tracking.replay.send_bulk_tracking_events')
+    def test_skips_errors_assets_and_invalid_times(self, mock_bulk):
+        mock_bulk.return_value = True
+        self.write_log([
+            '203.0.113.7 - - [10/Oct/2025:13:55:36 +0000] "GET /missing/ HTTP/1.1" 404 12 "-" "Mozilla/5.0"',
+            '203.0.113.7 - - [10/Oct/2025:13:55:37 +0000] "GET /static/app.JS HTTP/1.1" 200 12 "-" "Mozilla/5.0"',
+            '203.0.113.7 - - [10/Oct/2025:13:55:38 +0000] "GET /media/upload/ HTTP/1.1" 200 12 "-" "Mozilla/5.0"',
+            '203.0.113.7 - - [99/Foo/2025:13:55:39 +0000] "GET /bad-time/ HTTP/1.1" 200 12 "-" "Mozilla/5.0"',
+            '203.0.113.7 - - [10/Oct/2025:13:55:40 +0000] "GET /moved/ HTTP/1.1" 301 0 "-" "Mozilla/5.0"',
+        ])
+        self.replay('--exclude-paths', '/media/')
+        self.assertEqual([e['params']['url'] for e in mock_bulk.call_args[0][0]],
+                         ['https://www.example.org/moved/'])
+        with open(self.checkpoint_path) as fh:
+            self.assertEqual(list(json.load(fh).values()), [[[1, 5]]])
+
+        os.remove(self.checkpoint_path)
+        self.replay('--status', '404', '--exclude-extensions', '')
+        self.assertEqual([e['params']['url'] for e in mock_bulk.call_args[0][0]],
+                         ['https://www.example.org/missing/'])
+
+
+class LazyImportTests(TestCase):
+
+    def loaded_modules(self, backend, **config):
+        script = (
+            "import sys, django; django.setup(); "
+            "from django.conf import settings; "
+            "settings.MATOMO_API_TRACKING = dict(settings.MATOMO_API_TRACKING, backend={!r}, **{!r}); "
+            "import matomo_api_tracking.middleware; "
+            "from matomo_api_tracking.dispatcher import get_backend; get_backend(); "
+            "print(','.join(m for m in ('bs4', 'celery', 'redis', 'requests') if m in sys.modules))"
+        ).format(backend, config)
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='test_settings')
+        output = subprocess.run(
+            [sys.executable, '-c', script], capture_output=True, text=True, env=env, check=True).stdout
+        return output.strip()
+
+    def test_optional_dependencies_are_not_imported(self):
+        self.assertEqual(
+            self.loaded_modules('matomo_api_tracking.backends.direct.DirectTrackingBackend'), '')
+        self.assertEqual(
+            self.loaded_modules('matomo_api_tracking.backends.redis_batch.RedisBatchTrackingBackend',
+                                redis_url='redis://localhost:6379/0'),
+            'redis')
+
+
+class LoadTestTests(TestCase):
+
+    def test_stub_server_records_single_and_bulk_requests(self):
+        with StubMatomoServer() as stub:
+            events = [{'params': {'idsite': 1, 'url': 'http://testserver/a/'}},
+                      {'params': {'idsite': 1, 'url': 'http://testserver/b/'}}]
+            self.assertTrue(send_bulk_tracking_events(events, stub.url, 'token', 2))
+        self.assertEqual(stub.requests, {'single': 0, 'bulk': 1, 'failed': 0})
+        self.assertEqual([hit['url'] for _, hit in stub.hits], ['http://testserver/a/', 'http://testserver/b/'])
+
+    def test_stub_server_injects_errors(self):
+        with StubMatomoServer(error_rate=1.0) as stub:
+            events = [{'params': {'idsite': 1}}]
+            self.assertFalse(send_bulk_tracking_events(events, stub.url, 'token', 2))
+        self.assertEqual(stub.requests['failed'], 1)
+        self.assertEqual(stub.hits, [])
+
+    def test_run_load_test_reports_delivery(self):
+        with StubMatomoServer() as stub:
+            result = run_load_test('direct', stub, requests=20, concurrency=4, drain_timeout=5)
+        self.assertEqual(result['loss_rate'], 0)
+        self.assertEqual(result['duplicate_rate'], 0)
+        self.assertEqual(result['stub_requests']['single'], 20)
+        self.assertIsNotNone(result['lag_p95'])
+
+    @patch('matomo_api_tracking.loadtest._flush_loop')
+    @patch('matomo_api_tracking.connections._clients', {})
+    @patch('matomo_api_tracking.connections.redis')
+    def test_redis_batch_run_uses_own_queue(self, mock_redis_module, mock_flush_loop):
+        mock_redis = mock_redis_module.Redis.return_value
+        mock_redis.scan_iter.side_effect = lambda match: [match[:-1], match[:-1] + ':agg']
+        config = {
+            'redis_url': 'redis://localhost:6379/0',
+            'sites': {'testserver': 2},
+            'priority_paths': {'/loadtest/': 'high'},
+        }
+        with StubMatomoServer() as stub:
+            run_load_test('redis_batch', stub, requests=3, concurrency=1, config=config, drain_timeout=0)
+
+        keys = {c[0][0] for c in mock_redis.rpush.call_args_list}
+        self.assertEqual(len(keys), 1)
+        key = keys.pop()
+        self.assertTrue(key.startswith('matomo_loadtest:'))
+        mock_redis.delete.assert_has_calls([call(key), call(key + ':agg')])
@@ -5,11 +5,20 @@ from urllib.parse import urlencode
 logger = logging.getLogger(__name__)
 
 
-def send_single_tracking_event(params: dict, meta: dict, matomo_url: str, timeout: float = 8) -> bool:
+def send_single_tracking_event(
+    params: dict,
+    meta: dict,
+    matomo_url: str,
+    timeout: float = 8,
+    token_auth: str = None,
+) -> bool:
     """
     Send a single tracking request to Matomo using GET.
+    Matomo only accepts the visitor IP (``cip``) with the ``token_auth`` of the site.
     Returns True on success.
     """
+    if token_auth is not None and "cip" in params:
+        params = dict(params, token_auth=token_auth)
     headers = {
         "User-Agent": meta.get("user_agent", ""),
         "Accept-Language": meta.get("language", ""),
@@ -1,8 +1,13 @@
 import hashlib
+import threading
 import time
 import uuid
 import random
+from functools import lru_cache, wraps
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.encoding import iri_to_uri
 from django.utils.translation import get_language_from_request
 
 VERSION = '1'
@@ -29,100 +34,213 @@ def get_visitor_id(cookie, client_ip, request):
     return cid[:16]
 
 
+def get_client_ip(meta):
+    client_ip = meta.get('HTTP_X_FORWARDED_FOR')
+    if client_ip:
+        # The values in a proxied environment are usually presented in the
+        # following format:
+        # X-Forwarded-For: client, proxy1, proxy2
+        # In this case, we want the client IP Only
+        return client_ip.split(',', 1)[0]
+    return meta.get('REMOTE_ADDR', '')
+
+
 def set_cookie(params, response):
-    COOKIE_USER_PERSISTENCE = params.get('COOKIE_USER_PERSISTENCE')
-    COOKIE_PATH = params.get('COOKIE_PATH')
+    cookie_persistence = params.get('COOKIE_USER_PERSISTENCE', COOKIE_USER_PERSISTENCE)
+    cookie_path = params.get('COOKIE_PATH', COOKIE_PATH)
     visitor_id = params.get('visitor_id')
 
-    time_tup = time.localtime(time.time() + COOKIE_USER_PERSISTENCE)
+    time_tup = time.localtime(time.time() + cookie_persistence)
 
     # always try and add the cookie to the response
     response.set_cookie(
         COOKIE_NAME,
         value=visitor_id,
         expires=time.strftime('%a, %d-%b-%Y %H:%M:%S %Z', time_tup),
-        path=COOKIE_PATH,
+        path=cookie_path,
     )
     return response
 
 
-def build_api_params(
-        request, account, path=None, referer=None, title=None,
-        user_id=None, custom_params=None):
-    if custom_params is None:
-        custom_params = {}
-
-    meta = request.META
-    # determine the referrer
-    referer = referer or request.GET.get('r', '')
-
-    custom_uip = None
-    if hasattr(settings, 'CUSTOM_UIP_HEADER') and settings.CUSTOM_UIP_HEADER:
-        custom_uip = meta.get(settings.CUSTOM_UIP_HEADER)
-    path = path or request.GET.get('p', '/')
-    path = request.build_absolute_uri(path)
-
-    # get client ip address
-    if 'HTTP_X_FORWARDED_FOR' in meta and meta.get('HTTP_X_FORWARDED_FOR', ''):
-        client_ip = meta.get('HTTP_X_FORWARDED_FOR', '')
-        if client_ip:
-            # The values in a proxied environment are usually presented in the
-            # following format:
-            # X-Forwarded-For: client, proxy1, proxy2
-            # In this case, we want the client IP Only
-            client_ip = client_ip.split(',')[0]
-    else:
-        client_ip = meta.get('REMOTE_ADDR', '')
-
-    user_agent = meta.get('HTTP_USER_AGENT') or meta.get('USER_AGENT', 'Unknown')
-
-    # try and get visitor_id from cookie, or genereate one
-    cookie = request.COOKIES.get(COOKIE_NAME)
-    visitor_id = get_visitor_id(cookie, client_ip, request)
-
-    # build the parameter collection
-    params = {
-        'apiv': VERSION,
-        'idsite': account,
-        'rec': 1,
-        'rand': str(random.randint(0, 0x7fffffff)),
-        '_id': visitor_id,
-        'urlref': referer,
-        'url': path,
-        'cdt': int(time.time()),
-        'ua': user_agent,
-    }
+class _LanguageRequest:
+    """The parts of a request used by ``get_language_from_request``."""
+    __slots__ = ('COOKIES', 'META')
+
+    def __init__(self, cookie_name, cookie_language, accept_language):
+        self.COOKIES = {cookie_name: cookie_language} if cookie_language else {}
+        self.META = {'HTTP_ACCEPT_LANGUAGE': accept_language} if accept_language else {}
+
 
-    # add user ID if exists
-    if user_id:
-        params.update({'uid': user_id})
+class ParamBuilder:
+    """Builds the Matomo tracking parameters of a request.
 
-    # if token_auth is specified, we can add the cip parameter (visitor's IP)
-    if 'token_auth' in settings.MATOMO_API_TRACKING:
-        params['cip'] = custom_uip or client_ip
+    Everything that only depends on the settings is evaluated once when the
+    builder is created. Locale resolution and the scheme+host prefix of the
+    tracked url are cached, as both repeat for most requests. Use
+    ``get_param_builder()`` to get the builder for the current settings.
+    """
 
-    # add custom parameters
-    params.update(custom_params)
+    def __init__(self, config, custom_uip_header=None, cache_size=1024):
+        self.send_cip = 'token_auth' in config
+        self.custom_uip_header = custom_uip_header
+        self.language_code = settings.LANGUAGE_CODE
+        self.language_cookie = settings.LANGUAGE_COOKIE_NAME
+        self.resolve_language = lru_cache(maxsize=cache_size)(self._resolve_language)
+        self.url_prefix = lru_cache(maxsize=cache_size)(self._url_prefix)
+
+    def _resolve_language(self, cookie_language, accept_language):
+        return get_language_from_request(
+            _LanguageRequest(self.language_cookie, cookie_language, accept_language))
+
+    @staticmethod
+    def _url_prefix(scheme, host):
+        # iri_to_uri() encodes character by character, so the encoded prefix
+        # can be cached and joined with the separately encoded path
+        return iri_to_uri('{}://{}'.format(scheme, host))
+
+    def absolute_url(self, request, path, host=None):
+        if path.startswith('/') and not path.startswith('//') and '/.' not in path:
+            prefix = self.url_prefix(request.scheme, host or request.get_host())
+            return prefix + iri_to_uri(path)
+        return request.build_absolute_uri(path)
+
+    def build(self, request, account, path=None, referer=None, title=None,
+              user_id=None, custom_params=None, host=None, send_cip=None):
+        """Return the Matomo parameters and the (compact) meta data of a hit.
+
+        ``host`` can be passed if ``request.get_host()`` was already called.
+        ``send_cip`` tells whether the hit is sent with a ``token_auth``, so
+        the visitor's IP can be added; it defaults to the global setting.
+        """
+        meta = request.META
+
+        path = self.absolute_url(request, path or request.GET.get('p', '/'), host)
+
+        client_ip = get_client_ip(meta)
+        user_agent = meta.get('HTTP_USER_AGENT') or meta.get('USER_AGENT', 'Unknown')
+        visitor_id = get_visitor_id(request.COOKIES.get(COOKIE_NAME), client_ip, request)
+
+        params = {
+            'apiv': VERSION,
+            'idsite': account,
+            'rec': 1,
+            'rand': str(random.getrandbits(31)),
+            '_id': visitor_id,
+            'urlref': referer or request.GET.get('r', ''),
+            'url': path,
+            'cdt': int(time.time()),
+            'ua': user_agent,
+        }
 
-    # add page title if supplied
-    if title:
-        if isinstance(title, bytes):
-            title = title.decode('utf-8')
-        params['action_name'] = title
+        # add user ID if exists
+        if user_id:
+            params['uid'] = user_id
 
-    locale = get_language_from_request(request)
-    if locale:
-        params['lang'] = locale
+        # if token_auth is specified, we can add the cip parameter (visitor's IP)
+        if self.send_cip if send_cip is None else send_cip:
+            custom_uip = meta.get(self.custom_uip_header) if self.custom_uip_header else None
+            params['cip'] = custom_uip or client_ip
 
-    return {
-        "matomo_params": params,
-        "meta": {
+        if custom_params:
+            params.update(custom_params)
+
+        # add page title if supplied
+        if title:
+            if isinstance(title, bytes):
+                title = title.decode('utf-8')
+            params['action_name'] = title
+
+        locale = self.resolve_language(
+            request.COOKIES.get(self.language_cookie), meta.get('HTTP_ACCEPT_LANGUAGE'))
+        if locale:
+            params['lang'] = locale
+
+        return params, {
             'user_agent': user_agent,
-            'language': locale or settings.LANGUAGE_CODE,
+            'language': locale or self.language_code,
             'visitor_id': visitor_id,
             'client_ip': client_ip,
-            'COOKIE_USER_PERSISTENCE': COOKIE_USER_PERSISTENCE,
-            'COOKIE_NAME': COOKIE_NAME,
-            'COOKIE_PATH': COOKIE_PATH,
         }
+
+
+_param_builder = None
+
+
+def get_param_builder():
+    """Return the parameter builder for the current settings."""
+    global _param_builder
+    if _param_builder is None:
+        _param_builder = ParamBuilder(
+            settings.MATOMO_API_TRACKING, getattr(settings, 'CUSTOM_UIP_HEADER', None))
+    return _param_builder
+
+
+@receiver(setting_changed)
+def _reset_param_builder(**kwargs):
+    global _param_builder
+    _param_builder = None
+
+
+def build_api_params(
+        request, account, path=None, referer=None, title=None,
+        user_id=None, custom_params=None):
+    params, meta = get_param_builder().build(
+        request, account, path=path, referer=referer, title=title,
+        user_id=user_id, custom_params=custom_params)
+    meta.update({
+        'COOKIE_USER_PERSISTENCE': COOKIE_USER_PERSISTENCE,
+        'COOKIE_NAME': COOKIE_NAME,
+        'COOKIE_PATH': COOKIE_PATH,
+    })
+    return {
+        "matomo_params": params,
+        "meta": meta,
     }
+
+
+class DropCounter:
+    """Counts tracking events dropped under overload.
+
+    The first drop is logged right away, later ones are summed up and logged
+    with the next drop after ``interval`` seconds, so an overloaded process
+    writes at most one warning per interval.
+    """
+
+    def __init__(self, logger, message, interval=60.0):
+        self.logger = logger
+        self.message = message
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._count = 0
+        self._logged_at = None
+
+    def add(self, count=1):
+        now = time.monotonic()
+        with self._lock:
+            self._count += count
+            if self._logged_at is not None and now - self._logged_at < self.interval:
+                return
+            count, self._count, self._logged_at = self._count, 0, now
+        self.logger.warning("%s, dropped %d tracking events.", self.message, count)
+
+
+def cached_for_config(factory):
+    """Cache the result of ``factory(config)`` for the last config object.
+
+    The decorated function takes an optional ``config`` (default: the
+    ``MATOMO_API_TRACKING`` setting) and only calls ``factory`` again when
+    it gets another config object, e.g. after the settings were changed.
+    """
+    cached = (None, None)
+
+    @wraps(factory)
+    def get(config=None):
+        nonlocal cached
+        if config is None:
+            config = settings.MATOMO_API_TRACKING
+        cached_config, value = cached
+        if cached_config is not config:
+            value = factory(config)
+            cached = (config, value)
+        return value
+    return get